@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+from xls_model import Blocks
+
 class GrillBlocks(Blocks):
-  def export(self):
-    pass
+  """Blocks of the grill workbook, exported like any other blocks"""
@@ -23,6 +23,15 @@ def _cast_number(value):
     return long(value)
 
 
+def _cast_cached_value(value, data_type):
+    "Convert the cached result of a formula as string to the type of its cell"
+    if data_type == 'n':
+        return _cast_number(value)
+    elif data_type == 'b':
+        return bool(int(value))
+    return value
+
+
 class ReadOnlyCell(object):
 
     __slots__ =  ('parent', 'row', 'column', '_value', 'data_type', '_style_id', 'formula')
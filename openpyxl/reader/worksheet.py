@@ -10,7 +10,7 @@ from openpyxl.xml.functions import iterparse
 
 # package imports
 from openpyxl.cell import Cell
-from openpyxl.cell.read_only import _cast_number
+from openpyxl.cell.read_only import _cast_number, _cast_cached_value
 from openpyxl.worksheet import Worksheet, ColumnDimension, RowDimension
 from openpyxl.worksheet.page import PageMargins, PrintOptions, PrintPageSetup
 from openpyxl.worksheet.protection import SheetProtection
@@ -196,6 +196,9 @@ class WorkSheetParser(object):
                 value = self.shared_strings[int(value)]
             elif data_type == 'str':
                 data_type = 's'
+            elif data_type == 'f':
+                # keep the cached result along with the formula
+                value = _cast_cached_value(value, element.get('t', 'n'))
 
         else:
             if data_type == 'inlineStr':
@@ -10,7 +10,7 @@ from openpyxl.compat import range
 
 # package
 from openpyxl.compat import removed_method
-from openpyxl.xml.functions import iterparse, safe_iterator
+from openpyxl.xml.functions import iterparse, safe_iterator, _iterparse
 from openpyxl.xml.constants import SHEET_MAIN_NS
 
 from openpyxl.worksheet import Worksheet
@@ -20,7 +20,8 @@ from openpyxl.utils import (
     get_column_letter,
     coordinate_to_tuple,
 )
-from openpyxl.cell.read_only import ReadOnlyCell, EMPTY_CELL
+from openpyxl.cell.read_only import ReadOnlyCell, EMPTY_CELL, _cast_cached_value
+from openpyxl.formula.translate import Translator
 
 
 def read_dimension(source):
@@ -57,16 +58,19 @@ def read_dimension(source):
 
 
 ROW_TAG = '{%s}row' % SHEET_MAIN_NS
+DATA_TAG = '{%s}sheetData' % SHEET_MAIN_NS
 CELL_TAG = '{%s}c' % SHEET_MAIN_NS
 VALUE_TAG = '{%s}v' % SHEET_MAIN_NS
 FORMULA_TAG = '{%s}f' % SHEET_MAIN_NS
 DIMENSION_TAG = '{%s}dimension' % SHEET_MAIN_NS
+INLINE_STRING_TAG = '{%s}is/{%s}t' % (SHEET_MAIN_NS, SHEET_MAIN_NS)
 
 CELL_TAGS = (CELL_TAG, VALUE_TAG, FORMULA_TAG)
 
 class ReadOnlyWorksheet(Worksheet):
 
     _xml = None
+    _shared_formula_masters = None
     _min_column = 1
     _min_row = 1
     _max_column = _max_row = None
@@ -105,9 +109,18 @@ class ReadOnlyWorksheet(Worksheet):
         else:
             empty_row = []
         row_counter = min_row
+        self._shared_formula_masters = {}
+
+        # rows read are detached from sheetData, so memory does not grow
+        # with the number of rows
+        sheet_data = None
+        p = _iterparse(self.xml_source, events=('start', 'end'))
+        for event, element in p:
+            if event == 'start':
+                if element.tag == DATA_TAG:
+                    sheet_data = element
+                continue
 
-        p = iterparse(self.xml_source, tag=[ROW_TAG], remove_blank_text=True)
-        for _event, element in p:
             if element.tag == ROW_TAG:
                 row_id = int(element.get("r"))
 
@@ -129,6 +142,8 @@ class ReadOnlyWorksheet(Worksheet):
                 # sub-elements of rows should be skipped as handled within a cell
                 continue
             element.clear()
+            if element.tag == ROW_TAG and sheet_data is not None:
+                del sheet_data[:]
 
 
     def _get_row(self, element, min_col=1, max_col=None):
@@ -154,12 +169,25 @@ class ReadOnlyWorksheet(Worksheet):
 
                 formula_value = None
 
-                formula = cell.findtext(FORMULA_TAG)
-                if formula is not None and not data_only:
-                    #data_type = 'f'
-                    formula_value = "=%s" % formula
-
                 value = cell.findtext(VALUE_TAG) or None
+                if value is None and data_type == 'inlineStr':
+                    value = cell.findtext(INLINE_STRING_TAG)
+
+                formula = cell.find(FORMULA_TAG)
+                if formula is not None and not data_only:
+                    # as the full reader: keep the cached result along with
+                    # the formula and expand shared formulas from their master
+                    if value is not None:
+                        value = _cast_cached_value(value, data_type)
+                    data_type = 'f'
+                    formula_value = "=%s" % (formula.text or '')
+                    if formula.get('t') == 'shared':
+                        si = formula.get('si')
+                        if si in self._shared_formula_masters:
+                            trans = self._shared_formula_masters[si]
+                            formula_value = trans.translate_formula(coordinate)
+                        else:
+                            self._shared_formula_masters[si] = Translator(formula_value, coordinate)
 
                 yield ReadOnlyCell(self, row, column,
                                    value, data_type, style_id, formula_value)
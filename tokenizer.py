@@ -23,6 +23,7 @@
 #========================================================================
 import re
 import collections
+import concurrent.futures
 
 #========================================================================
 #       Class: ExcelParserTokens
@@ -67,6 +68,8 @@ class ExcelParserTokens:
 #     Methods: f_token  - __init__()
 #========================================================================
 class f_token:
+    __slots__ = ("tvalue", "ttype", "tsubtype")
+
     def __init__(self, value, type, subtype):
         self.tvalue   = value
         self.ttype    = type
@@ -177,6 +180,11 @@ class f_tokenStack(ExcelParserTokens):
     def subtype(self):
         return ((self.token()) and [(self.token()).tsubtype] or [""])[0]
 
+# characters that may end a token or change the state of the scanner
+SPECIAL_CHARS     = re.compile(r"[\"'\[#{};, +\-*/^&=<>%(),]")
+SCIENTIFIC_NUMBER = re.compile(r"^[1-9]{1}(\.[0-9]+)?[eE]{1}$")
+ERROR_VALUES      = ("#NULL!", "#DIV/0!", "#VALUE!", "#REF!", "#NAME?", "#NUM!", "#N/A")
+
 #========================================================================
 #       Class: ExcelParser
 # Description: Parse an Excel formula into a stream of tokens
@@ -187,252 +195,155 @@ class f_tokenStack(ExcelParserTokens):
 #========================================================================
 class ExcelParser(ExcelParserTokens):
     def getTokens(self, formula):
-    
-        def currentChar():
-            return formula[offset]
-    
-        def doubleChar():
-            return formula[offset:offset+2]
-        
-        def nextChar():
-            # JavaScript returns an empty string if the index is out of bounds,
-            # Python throws an IndexError.  We mimic this behaviour here.
-            try:
-                formula[offset+1]
-            except IndexError:
-                return ""
-            else:            
-                return formula[offset+1]
-        
-        def EOF():
-            return offset >= len(formula)
-    
         tokens     = f_tokens()
         tokenStack = f_tokenStack()
-        offset     = 0
-        token      = ""
-        inString   = False
-        inPath     = False
-        inRange    = False
-        inError    = False
-    
-        while (len(formula) > 0):
-            if (formula[0] == " "):
-                formula = formula[1:]
-            else:
-                if (formula[0] == "="):
-                    formula = formula[1:]
-                break;    
-    
-        # state-dependent character evaluation (order is important)
-        while not EOF():
-               
-            # double-quoted strings
-            # embeds are doubled
-            # end marks token
-            if inString:
-                if currentChar() == "\"":
-                    if nextChar() == "\"":
-                        token += "\""
-                        offset += 1
-                    else:
-                        inString = False
-                        tokens.add(token, self.TOK_TYPE_OPERAND, self.TOK_SUBTYPE_TEXT)
-                        token = ""
-                else:
-                    token += currentChar()
+        length     = len(formula)
+
+        # skip leading white-space and "="
+        offset = length - len(formula.lstrip(" "))
+        if formula[offset:offset+1] == "=":
+            offset += 1
+
+        # the token accumulated so far is prefix (the text of a link) followed
+        # by formula[start:offset], it is sliced out once it is complete
+        prefix = ""
+        start  = offset
+
+        while offset < length:
+            # skip to the next character that may end or change the token
+            match = SPECIAL_CHARS.search(formula, offset)
+            if match is None:
+                offset = length
+                break
+            offset = match.start()
+            char   = match.group()
+            token  = prefix + formula[start:offset]
+
+            # scientific notation check
+            if char in "+-" and len(token) > 1 and SCIENTIFIC_NUMBER.match(token):
                 offset += 1
                 continue
-    
-            # single-quoted strings (links)
-            # embeds are double
-            # end does not mark a token
-            if inPath:
-                if currentChar() == "'":
-                    if nextChar() == "'":
-                        token += "'"
-                        offset += 1
-                    else:
-                        inPath = False
-                else:
-                    token += currentChar()
-                offset += 1;
-                continue;    
-    
+
             # bracketed strings (range offset or linked workbook name)
             # no embeds (changed to "()" by Excel)
             # end does not mark a token
-            if inRange:
-                if currentChar() == "]":
-                    inRange = False
-                token += currentChar()
-                offset += 1
+            if char == "[":
+                offset = formula.find("]", offset + 1)
+                offset = length if offset == -1 else offset + 1
                 continue
-    
-            # error values
-            # end marks a token, determined from absolute list of values
-            if inError:
-                token += currentChar()
-                offset += 1
-                if ",#NULL!,#DIV/0!,#VALUE!,#REF!,#NAME?,#NUM!,#N/A,".find("," + token + ",") != -1:
-                    inError = False
-                    tokens.add(token, self.TOK_TYPE_OPERAND, self.TOK_SUBTYPE_ERROR)
-                    token = ""
-                continue;
-    
-            # scientific notation check
-            regexSN = '^[1-9]{1}(\.[0-9]+)?[eE]{1}$';
-            if (("+-").find(currentChar()) != -1):
-                if len(token) > 1:
-                    if re.match(regexSN,token):
-                        token += currentChar();
-                        offset += 1;
-                        continue;
-              
-            # independent character evaulation (order not important)
-            #
-            # establish state-dependent character evaluations
-            if currentChar() == "\"":
-                if len(token) > 0:
-                    # not expected
-                    tokens.add(token, self.TOK_TYPE_UNKNOWN)
-                    token = ""
-                inString = True
-                offset += 1
-                continue
-    
-            if currentChar() == "'":
-                if len(token) > 0:
+
+            # all other characters end the token at hand
+            if char == "\"" or char == "'" or char == "#" or char == "{":
+                if token:
                     # not expected
                     tokens.add(token, self.TOK_TYPE_UNKNOWN)
-                    token = ""
-                inPath = True
-                offset += 1
-                continue
-    
-            if (currentChar() == "["):
-                inRange = True
-                token += currentChar()
-                offset += 1
+            elif char != "(" and token:
+                tokens.add(token, self.TOK_TYPE_OPERAND)
+            prefix = ""
+            start  = offset + 1
+
+            # double-quoted strings
+            # embeds are doubled
+            # end marks token
+            #
+            # single-quoted strings (links)
+            # embeds are doubled
+            # end does not mark a token
+            if char == "\"" or char == "'":
+                close = offset
+                while True:
+                    close = formula.find(char, close + 1)
+                    if close == -1 or formula[close+1:close+2] != char:
+                        break
+                    close += 1
+                if close == -1:
+                    close = length
+                text = formula[offset+1:close].replace(char + char, char)
+                offset = start = min(close + 1, length)
+                if char == "'" or close == length:
+                    prefix = text
+                else:
+                    tokens.add(text, self.TOK_TYPE_OPERAND, self.TOK_SUBTYPE_TEXT)
                 continue
-    
-            if (currentChar() == "#"):
-                if (len(token) > 0):
-                    # not expected
-                    tokens.add(token, self.TOK_TYPE_UNKNOWN)
-                    token = ""
-                inError = True
-                token += currentChar()
-                offset += 1
+
+            # error values
+            # end marks a token, determined from absolute list of values
+            if char == "#":
+                for error in ERROR_VALUES:
+                    if formula.startswith(error, offset):
+                        tokens.add(error, self.TOK_TYPE_OPERAND, self.TOK_SUBTYPE_ERROR)
+                        offset = start = offset + len(error)
+                        break
+                else:
+                    start, offset = offset, length
                 continue
-    
+
             # mark start and end of arrays and array rows
-            if (currentChar() == "{"):
-                if (len(token) > 0):
-                    # not expected
-                    tokens.add(token, self.TOK_TYPE_UNKNOWN)
-                    token = ""
+            if char == "{":
                 tokenStack.push(tokens.add("ARRAY", self.TOK_TYPE_FUNCTION, self.TOK_SUBTYPE_START))
                 tokenStack.push(tokens.add("ARRAYROW", self.TOK_TYPE_FUNCTION, self.TOK_SUBTYPE_START))
                 offset += 1
                 continue
-    
-            if (currentChar() == ";"):
-                if (len(token) > 0):
-                    tokens.add(token, self.TOK_TYPE_OPERAND)
-                    token = ""
+
+            if char == ";":
                 tokens.addRef(tokenStack.pop())
                 tokens.add(",", self.TOK_TYPE_ARGUMENT)
                 tokenStack.push(tokens.add("ARRAYROW", self.TOK_TYPE_FUNCTION, self.TOK_SUBTYPE_START))
                 offset += 1
                 continue
-    
-            if (currentChar() == "}"):
-                if (len(token) > 0):
-                    tokens.add(token, self.TOK_TYPE_OPERAND)
-                    token = ""
+
+            if char == "}":
                 tokens.addRef(tokenStack.pop())
                 tokens.addRef(tokenStack.pop())
                 offset += 1
                 continue
-    
+
             # trim white-space
-            if (currentChar() == " "):
-                if (len(token) > 0):
-                    tokens.add(token, self.TOK_TYPE_OPERAND)
-                    token = ""
+            if char == " ":
                 tokens.add("", self.TOK_TYPE_WSPACE)
-                offset += 1
-                while ((currentChar() == " ") and (not EOF())):
-                    offset += 1
+                offset = start = length - len(formula[offset:].lstrip(" "))
                 continue
-    
+
             # multi-character comparators
-            if (",>=,<=,<>,".find("," + doubleChar() + ",") != -1):
-                if (len(token) > 0):
-                    tokens.add(token, self.TOK_TYPE_OPERAND)
-                    token = ""
-                tokens.add(doubleChar(), self.TOK_TYPE_OP_IN, self.TOK_SUBTYPE_LOGICAL)
-                offset += 2
+            doubleChar = formula[offset:offset+2]
+            if doubleChar == ">=" or doubleChar == "<=" or doubleChar == "<>":
+                tokens.add(doubleChar, self.TOK_TYPE_OP_IN, self.TOK_SUBTYPE_LOGICAL)
+                offset = start = offset + 2
                 continue
-    
+
             # standard infix operators
-            if ("+-*/^&=><".find(currentChar()) != -1):
-                if (len(token) > 0):
-                    tokens.add(token, self.TOK_TYPE_OPERAND)
-                    token = ""
-                tokens.add(currentChar(), self.TOK_TYPE_OP_IN)
-                offset += 1
-                continue
-    
+            if char in "+-*/^&=><":
+                tokens.add(char, self.TOK_TYPE_OP_IN)
+
             # standard postfix operators
-            if ("%".find(currentChar()) != -1):
-                if (len(token) > 0):
-                    tokens.add(token, self.TOK_TYPE_OPERAND)
-                    token = ""
-                tokens.add(currentChar(), self.TOK_TYPE_OP_POST)
-                offset += 1
-                continue
-    
+            elif char == "%":
+                tokens.add(char, self.TOK_TYPE_OP_POST)
+
             # start subexpression or function
-            if (currentChar() == "("):
-                if (len(token) > 0):
+            elif char == "(":
+                if token:
                     tokenStack.push(tokens.add(token, self.TOK_TYPE_FUNCTION, self.TOK_SUBTYPE_START))
-                    token = ""
                 else:
                     tokenStack.push(tokens.add("", self.TOK_TYPE_SUBEXPR, self.TOK_SUBTYPE_START))
-                offset += 1
-                continue
-    
+
             # function, subexpression, array parameters
-            if (currentChar() == ","):
-                if (len(token) > 0):
-                    tokens.add(token, self.TOK_TYPE_OPERAND)
-                    token = ""
+            elif char == ",":
                 if (not (tokenStack.type() == self.TOK_TYPE_FUNCTION)):
-                    tokens.add(currentChar(), self.TOK_TYPE_OP_IN, self.TOK_SUBTYPE_UNION)
+                    tokens.add(char, self.TOK_TYPE_OP_IN, self.TOK_SUBTYPE_UNION)
                 else:
-                    tokens.add(currentChar(), self.TOK_TYPE_ARGUMENT)
-                offset += 1
-                continue
-    
+                    tokens.add(char, self.TOK_TYPE_ARGUMENT)
+
             # stop subexpression
-            if (currentChar() == ")"):
-                if (len(token) > 0):
-                    tokens.add(token, self.TOK_TYPE_OPERAND)
-                    token = ""
+            elif char == ")":
                 tokens.addRef(tokenStack.pop())
-                offset += 1
-                continue
-    
-            # token accumulation
-            token += currentChar()
+
             offset += 1
-    
+
         # dump remaining accumulation
-        if (len(token) > 0): 
+        token = prefix + formula[start:offset]
+        if (len(token) > 0):
             tokens.add(token, self.TOK_TYPE_OPERAND)
-    
+
         # move all tokens to a new collection, excluding all unnecessary white-space tokens
         tokens2 = f_tokens()
     
@@ -565,12 +476,16 @@ class ExcelParser(ExcelParserTokens):
         return output
 
 class Operator:
+    __slots__ = ("value", "precedence", "associativity")
+
     def __init__(self,value,precedence,associativity):
         self.value = value
         self.precedence = precedence
         self.associativity = associativity
 
 class ASTNode(object):
+    __slots__ = ("token",)
+
     def __init__(self,token):
         super(ASTNode,self).__init__()
         self.token = token
@@ -580,18 +495,24 @@ class ASTNode(object):
         return self.token.tvalue
     
 class OperatorNode(ASTNode):
+    __slots__ = ()
+
     def __init__(self,*args):
         super(OperatorNode,self).__init__(*args)
     def emit(self):
         pass
 
 class RangeNode(ASTNode):
+    __slots__ = ()
+
     def __init__(self,*args):
         super(RangeNode,self).__init__(*args)
     def emit(self):
         pass
     
 class FunctionNode(ASTNode):
+    __slots__ = ("num_args",)
+
     def __init__(self,*args):
         super(FunctionNode,self).__init__(*args)
         self.num_args = 0
@@ -599,6 +520,26 @@ class FunctionNode(ASTNode):
     def emit(self):
         pass
 
+#http://office.microsoft.com/en-us/excel-help/calculation-operators-and-precedence-HP010078886.aspx
+OPERATORS = {}
+OPERATORS[':'] = Operator(':',8,'left')
+OPERATORS[''] = Operator(' ',8,'left')
+OPERATORS[','] = Operator(',',8,'left')
+OPERATORS['u-'] = Operator('u-',7,'left') #unary negation
+OPERATORS['%'] = Operator('%',6,'left')
+OPERATORS['^'] = Operator('^',5,'left')
+OPERATORS['*'] = Operator('*',4,'left')
+OPERATORS['/'] = Operator('/',4,'left')
+OPERATORS['+'] = Operator('+',3,'left')
+OPERATORS['-'] = Operator('-',3,'left')
+OPERATORS['&'] = Operator('&',2,'left')
+OPERATORS['='] = Operator('=',1,'left')
+OPERATORS['<'] = Operator('<',1,'left')
+OPERATORS['>'] = Operator('>',1,'left')
+OPERATORS['<='] = Operator('<=',1,'left')
+OPERATORS['>='] = Operator('>=',1,'left')
+OPERATORS['<>'] = Operator('<>',1,'left')
+
 def create_node(t):
     if t.ttype == "operand" and t.tsubtype == "range":
         return RangeNode(t)
@@ -609,13 +550,13 @@ def create_node(t):
     else:
         return ASTNode(t)
 
-def shunting_yard(expression):
+def shunting_yard(expression, parser=None):
     
     #remove leading =
     if expression.startswith('='):
         expression = expression[1:]
         
-    p = ExcelParser();
+    p = parser or ExcelParser();
     p.parse(expression)
 
     # insert tokens for '(' and ')', to make things cleaner below
@@ -640,36 +581,11 @@ def shunting_yard(expression):
 
     #print "tokens: ", "|".join([x.tvalue for x in tokens])
 
-    #http://office.microsoft.com/en-us/excel-help/calculation-operators-and-precedence-HP010078886.aspx
-    operators = {}
-    operators[':'] = Operator(':',8,'left')
-    operators[''] = Operator(' ',8,'left')
-    operators[','] = Operator(',',8,'left')
-    operators['u-'] = Operator('u-',7,'left') #unary negation
-    operators['%'] = Operator('%',6,'left')
-    operators['^'] = Operator('^',5,'left')
-    operators['*'] = Operator('*',4,'left')
-    operators['/'] = Operator('/',4,'left')
-    operators['+'] = Operator('+',3,'left')
-    operators['-'] = Operator('-',3,'left')
-    operators['&'] = Operator('&',2,'left')
-    operators['='] = Operator('=',1,'left')
-    operators['<'] = Operator('<',1,'left')
-    operators['>'] = Operator('>',1,'left')
-    operators['<='] = Operator('<=',1,'left')
-    operators['>='] = Operator('>=',1,'left')
-    operators['<>'] = Operator('<>',1,'left')
-            
     output = collections.deque()
     stack = []
     were_values = []
     arg_count = []
     
-    def po():
-        print ("output: ", "|".join([x.tvalue for x in output]))
-    def so():
-        print ("stack:", "|".join([x.tvalue for x in stack]))
-    
     for t in tokens:
         if t.ttype == "operand":
             
@@ -700,17 +616,18 @@ def shunting_yard(expression):
         
         elif t.ttype.startswith('operator'):
             if t.ttype.endswith('-prefix') and t.tvalue =="-":
-                o1 = operators['u-']
+                o1 = OPERATORS['u-']
             else:
-                o1 = operators[t.tvalue]
+                o1 = OPERATORS[t.tvalue]
 
                 
-            while stack and stack[-1].ttype.startswith('operator'):
+            # a prefix operator has no left operand to take from the stack
+            while stack and stack[-1].ttype.startswith('operator') and not t.ttype.endswith('-prefix'):
                 
                 if stack[-1].ttype.endswith('-prefix') and stack[-1].tvalue =="-":
-                    o2 = operators['u-']
+                    o2 = OPERATORS['u-']
                 else:
-                    o2 = operators[stack[-1].tvalue]
+                    o2 = OPERATORS[stack[-1].tvalue]
                 
                 if ( (o1.associativity == "left" and o1.precedence <= o2.precedence)
                         or
@@ -753,3 +670,29 @@ def shunting_yard(expression):
     #print "Stack is: ", "|".join(stack)
     #print "Ouput is: ", "|".join([x.tvalue for x in output])
     return output
+
+def shunting_yard_list(expressions):
+    """Return list of the RPN of each expression, sharing one parser"""
+    p = ExcelParser()
+    return [shunting_yard(expression, p) for expression in expressions]
+
+def shunting_yard_batch(items, jobs=1, chunk_size=2000):
+    """Return list of tuples (coordinate, RPN) for the tuples (coordinate,
+    expression) items, in the same order.
+
+    Each distinct expression is parsed once and its RPN is shared by all
+    items having it, so the RPNs must not be modified. The distinct
+    expressions are parsed by a pool of jobs processes in chunks of
+    chunk_size (all cores if None, in process if 1)."""
+    items = list(items)
+    expressions = list(collections.OrderedDict.fromkeys(expression for _, expression in items))
+
+    if jobs == 1 or len(expressions) <= chunk_size:
+        rpns = shunting_yard_list(expressions)
+    else:
+        chunks = [expressions[k:k+chunk_size] for k in range(0, len(expressions), chunk_size)]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            rpns = [rpn for chunk in executor.map(shunting_yard_list, chunks) for rpn in chunk]
+
+    rpns = dict(zip(expressions, rpns))
+    return [(coordinate, rpns[expression]) for coordinate, expression in items]
@@ -0,0 +1,885 @@
+#!/usr/bin/env python3
+
+"""Streaming reader for legacy Excel 97-2003 (BIFF8) .xls workbooks.
+
+The workbook stream is read sector by sector from the OLE2 compound file.
+Sheets are parsed record by record when their rows are iterated, only the
+shared string table and the other workbook globals are kept in memory.
+BiffWorkbook mimics the read-only openpyxl workbook as far as ExcelLoader
+uses it."""
+
+import re
+import struct
+import math
+import collections
+
+from array import array
+
+from openpyxl.styles import is_date_format
+from openpyxl.styles.numbers import BUILTIN_FORMATS
+from openpyxl.utils.datetime import from_excel, CALENDAR_WINDOWS_1900, CALENDAR_MAC_1904
+
+
+COMPOUND_FILE_MAGIC = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+
+END_OF_CHAIN = 0xFFFFFFFE
+
+# BIFF8 record types
+BOF = 0x0809
+EOF = 0x000A
+CONTINUE = 0x003C
+FILEPASS = 0x002F
+DATEMODE = 0x0022
+BOUNDSHEET = 0x0085
+SST = 0x00FC
+FORMAT = 0x041E
+XF = 0x00E0
+EXTERNSHEET = 0x0017
+SUPBOOK = 0x01AE
+NAME = 0x0018
+DBCELL = 0x00D7
+LABELSST = 0x00FD
+LABEL = 0x0204
+NUMBER = 0x0203
+RK = 0x027E
+MULRK = 0x00BD
+BLANK = 0x0201
+MULBLANK = 0x00BE
+BOOLERR = 0x0205
+FORMULA = 0x0006
+STRING = 0x0207
+SHAREDFMLA = 0x04BC
+ARRAY = 0x0221
+TABLE = 0x0236
+
+ERRORS = {
+  0x00: '#NULL!', 0x07: '#DIV/0!', 0x0F: '#VALUE!', 0x17: '#REF!',
+  0x1D: '#NAME?', 0x24: '#NUM!', 0x2A: '#N/A'
+}
+
+MAX_ROW = 0xFFFF
+MAX_COLUMN = 0xFF
+
+
+class BiffError(Exception):
+  pass
+
+
+def is_compound_file(filename):
+  """Return True if filename is an OLE2 compound file like a BIFF .xls"""
+  with open(filename, 'rb') as f:
+    return f.read(8) == COMPOUND_FILE_MAGIC
+
+
+class CompoundFile:
+  """Directory and sector chains of an OLE2 compound file"""
+  def __init__(self, filename):
+    self.file = open(filename, 'rb')
+    try:
+      self.read_directory(filename)
+    except Exception:
+      self.file.close()
+      raise
+
+  def read_directory(self, filename):
+    """Read the header, the FAT and the directory entries"""
+    header = self.file.read(512)
+    if header[:8] != COMPOUND_FILE_MAGIC:
+      raise BiffError('{0} is no compound file'.format(filename))
+
+    sector_shift, mini_sector_shift = struct.unpack_from('<HH', header, 0x1E)
+    (fat_sectors, self.directory_start, _, self.mini_cutoff, mini_fat_start,
+     _, difat_start, difat_sectors) = struct.unpack_from('<IIIIIIII', header, 0x2C)
+    self.sector_size = 1 << sector_shift
+    self.mini_sector_size = 1 << mini_sector_shift
+
+    # the FAT sectors are listed by the header and the DIFAT chain
+    fat_index = [s for s in struct.unpack_from('<109I', header, 0x4C) if s < END_OF_CHAIN]
+    per_sector = self.sector_size // 4
+    sector = difat_start
+    for _ in range(difat_sectors):
+      if sector >= END_OF_CHAIN:
+        break
+      entries = struct.unpack('<{0}I'.format(per_sector), self.read_sector(sector))
+      fat_index += [s for s in entries[:-1] if s < END_OF_CHAIN]
+      sector = entries[-1]
+
+    self.fat = array('I')
+    for sector in fat_index[:fat_sectors]:
+      self.fat.frombytes(self.read_sector(sector))
+
+    self.entries = {}
+    directory = self.read_chain(self.directory_start)
+    for k in range(0, len(directory), 128):
+      entry = directory[k:k+128]
+      name_size, type_ = struct.unpack_from('<HB', entry, 0x40)
+      if not type_:
+        continue
+      name = entry[:max(name_size-2, 0)].decode('utf-16-le')
+      start, size = struct.unpack_from('<II', entry, 0x74)
+      self.entries[name] = (type_, start, size)
+
+    root = self.entries.get('Root Entry')
+    self.mini_stream = root and self.read_chain(root[1])[:root[2]] or b''
+    self.mini_fat = array('I', self.read_chain(mini_fat_start) if mini_fat_start < END_OF_CHAIN else b'')
+
+  def read_sector(self, sector):
+    self.file.seek((sector+1) * self.sector_size)
+    return self.file.read(self.sector_size)
+
+  def chain(self, start, fat):
+    """Return list of the sectors of the chain starting with start"""
+    sectors = []
+    sector = start
+    while sector < END_OF_CHAIN:
+      if sector >= len(fat) or len(sectors) > len(fat):
+        raise BiffError('damaged sector chain')
+      sectors.append(sector)
+      sector = fat[sector]
+    return sectors
+
+  def read_chain(self, start):
+    return b''.join(self.read_sector(s) for s in self.chain(start, self.fat))
+
+  def open_stream(self, name):
+    """Return file-like object for stream name"""
+    if name not in self.entries:
+      return None
+    _, start, size = self.entries[name]
+
+    if size < self.mini_cutoff:
+      n = self.mini_sector_size
+      data = b''.join(self.mini_stream[s*n:(s+1)*n] for s in self.chain(start, self.mini_fat))
+      return SectorStream(self, None, size, data)
+    return SectorStream(self, self.chain(start, self.fat), size)
+
+  def close(self):
+    self.file.close()
+
+
+class SectorStream:
+  """Sequentially read stream scattered over sectors of a compound file,
+  holding one sector at a time"""
+  def __init__(self, compound_file, sectors, size, data=None):
+    self.compound_file = compound_file
+    self.sectors = sectors
+    self.size = size
+    self.position = 0
+    self.data = data
+    self.data_start = 0
+
+  def seek(self, position):
+    self.position = position
+
+  def read(self, n):
+    parts = []
+    while n > 0 and self.position < self.size:
+      k = self.position - self.data_start
+      if self.data is None or not 0 <= k < len(self.data):
+        sector_size = self.compound_file.sector_size
+        index = self.position // sector_size
+        self.data = self.compound_file.read_sector(self.sectors[index])
+        self.data_start = index * sector_size
+        k = self.position - self.data_start
+      part = self.data[k:k+min(n, self.size-self.position)]
+      if not part:
+        break
+      parts.append(part)
+      self.position += len(part)
+      n -= len(part)
+    return b''.join(parts)
+
+
+def iter_records(stream, position=0):
+  """Return generator for tuples (type, payload) of the records starting at
+  position, CONTINUE records being yielded as they are"""
+  stream.seek(position)
+  while True:
+    header = stream.read(4)
+    if len(header) < 4:
+      return
+    type_, size = struct.unpack('<HH', header)
+    yield type_, stream.read(size)
+
+
+class Unicode:
+  """Reader for the strings of a record and its CONTINUE records. Character
+  data split between records continues with a new option byte."""
+  def __init__(self, parts):
+    self.parts = parts
+    self.part = 0
+    self.position = 0
+
+  def read(self, n):
+    data = b''
+    while len(data) < n:
+      if self.position >= len(self.parts[self.part]):
+        self.part += 1
+        self.position = 0
+      chunk = self.parts[self.part][self.position:self.position+n-len(data)]
+      self.position += len(chunk)
+      data += chunk
+    return data
+
+  def read_chars(self, count, wide):
+    chars = []
+    while count > 0:
+      if self.position >= len(self.parts[self.part]):
+        self.part += 1
+        self.position = 0
+        wide = self.parts[self.part][0] & 0x01
+        self.position = 1
+      size = wide and 2 or 1
+      available = (len(self.parts[self.part]) - self.position) // size
+      n = min(count, available)
+      data = self.parts[self.part][self.position:self.position+n*size]
+      chars.append(data.decode(wide and 'utf-16-le' or 'latin-1'))
+      self.position += n*size
+      count -= n
+    return ''.join(chars)
+
+  def read_string(self, length_size=2):
+    """Return the next XLUnicodeRichExtendedString"""
+    count = struct.unpack(length_size == 2 and '<H' or '<B', self.read(length_size))[0]
+    flags = self.read(1)[0]
+    runs = flags & 0x08 and struct.unpack('<H', self.read(2))[0] or 0
+    ext = flags & 0x04 and struct.unpack('<I', self.read(4))[0] or 0
+    text = self.read_chars(count, flags & 0x01)
+    self.read(runs*4 + ext)
+    return text
+
+
+def unicode_string(data, offset, length_size=2):
+  """Return tuple (string, end offset) of an XLUnicodeString in data"""
+  reader = Unicode([data[offset:]])
+  text = reader.read_string(length_size)
+  return text, offset + reader.position
+
+
+def decode_rk(rk):
+  """Return number encoded as RK value"""
+  if rk & 0x02:
+    value = rk >> 2
+    if value & 0x20000000:
+      value -= 0x40000000
+  else:
+    value = struct.unpack('<d', struct.pack('<Q', (rk & 0xFFFFFFFC) << 32))[0]
+  if rk & 0x01:
+    value /= 100
+  return value
+
+
+def number(value):
+  """Return number as the xlsx readers do, integral floats as int"""
+  if isinstance(value, float) and value.is_integer() and abs(value) < 2**53:
+    return int(value)
+  return value
+
+
+def column_letters(column):
+  letters = ''
+  column += 1
+  while column:
+    column, k = divmod(column-1, 26)
+    letters = chr(65+k) + letters
+  return letters
+
+
+def quote_sheet_name(name):
+  if re.match(r'^[A-Za-z_][A-Za-z0-9_.]*$', name):
+    return name
+  return "'{0}'".format(name.replace("'", "''"))
+
+
+# built-in functions as index -> (name, fixed argument count or None)
+FUNCTIONS = {
+  0: ('COUNT', None), 1: ('IF', None), 2: ('ISNA', 1), 3: ('ISERROR', 1),
+  4: ('SUM', None), 5: ('AVERAGE', None), 6: ('MIN', None), 7: ('MAX', None),
+  8: ('ROW', None), 9: ('COLUMN', None), 10: ('NA', 0), 11: ('NPV', None),
+  12: ('STDEV', None), 13: ('DOLLAR', None), 14: ('FIXED', None), 15: ('SIN', 1),
+  16: ('COS', 1), 17: ('TAN', 1), 18: ('ATAN', 1), 19: ('PI', 0), 20: ('SQRT', 1),
+  21: ('EXP', 1), 22: ('LN', 1), 23: ('LOG10', 1), 24: ('ABS', 1), 25: ('INT', 1),
+  26: ('SIGN', 1), 27: ('ROUND', 2), 28: ('LOOKUP', None), 29: ('INDEX', None),
+  30: ('REPT', 2), 31: ('MID', 3), 32: ('LEN', 1), 33: ('VALUE', 1),
+  34: ('TRUE', 0), 35: ('FALSE', 0), 36: ('AND', None), 37: ('OR', None),
+  38: ('NOT', 1), 39: ('MOD', 2), 46: ('VAR', None), 48: ('TEXT', 2),
+  56: ('PV', None), 57: ('FV', None), 58: ('NPER', None), 59: ('PMT', None),
+  60: ('RATE', None), 61: ('MIRR', 3), 62: ('IRR', None), 63: ('RAND', 0),
+  64: ('MATCH', None), 65: ('DATE', 3), 66: ('TIME', 3), 67: ('DAY', 1),
+  68: ('MONTH', 1), 69: ('YEAR', 1), 70: ('WEEKDAY', None), 71: ('HOUR', 1),
+  72: ('MINUTE', 1), 73: ('SECOND', 1), 74: ('NOW', 0), 75: ('AREAS', 1),
+  76: ('ROWS', 1), 77: ('COLUMNS', 1), 78: ('OFFSET', None), 82: ('SEARCH', None),
+  83: ('TRANSPOSE', 1), 86: ('TYPE', 1), 97: ('ATAN2', 2), 98: ('ASIN', 1),
+  99: ('ACOS', 1), 100: ('CHOOSE', None), 101: ('HLOOKUP', None),
+  102: ('VLOOKUP', None), 105: ('ISREF', 1), 109: ('LOG', None), 111: ('CHAR', 1),
+  112: ('LOWER', 1), 113: ('UPPER', 1), 114: ('PROPER', 1), 115: ('LEFT', None),
+  116: ('RIGHT', None), 117: ('EXACT', 2), 118: ('TRIM', 1), 119: ('REPLACE', 4),
+  120: ('SUBSTITUTE', None), 121: ('CODE', 1), 124: ('FIND', None), 125: ('CELL', None),
+  126: ('ISERR', 1), 127: ('ISTEXT', 1), 128: ('ISNUMBER', 1), 129: ('ISBLANK', 1),
+  130: ('T', 1), 131: ('N', 1), 140: ('DATEVALUE', 1), 141: ('TIMEVALUE', 1),
+  142: ('SLN', 3), 143: ('SYD', 4), 144: ('DDB', None), 148: ('INDIRECT', None),
+  162: ('CLEAN', 1), 163: ('MDETERM', 1), 164: ('MINVERSE', 1), 165: ('MMULT', 2),
+  167: ('IPMT', None), 168: ('PPMT', None), 169: ('COUNTA', None),
+  183: ('PRODUCT', None), 184: ('FACT', 1), 189: ('DPRODUCT', 3), 190: ('ISNONTEXT', 1),
+  193: ('STDEVP', None), 194: ('VARP', None), 197: ('TRUNC', None), 198: ('ISLOGICAL', 1),
+  205: ('FINDB', None), 212: ('ROUNDUP', 2), 213: ('ROUNDDOWN', 2), 216: ('RANK', None),
+  219: ('ADDRESS', None), 220: ('DAYS360', None), 221: ('TODAY', 0), 222: ('VDB', None),
+  227: ('MEDIAN', None), 228: ('SUMPRODUCT', None), 229: ('SINH', 1), 230: ('COSH', 1),
+  231: ('TANH', 1), 247: ('DB', None), 252: ('FREQUENCY', 2), 255: (None, None),
+  261: ('ERROR.TYPE', 1), 269: ('AVEDEV', None), 276: ('COMBIN', 2), 279: ('EVEN', 1),
+  285: ('FLOOR', 2), 288: ('CEILING', 2), 298: ('ODD', 1), 300: ('POISSON', 3),
+  303: ('SUMXMY2', 2), 304: ('SUMX2MY2', 2), 305: ('SUMX2PY2', 2), 307: ('CORREL', 2),
+  308: ('COVAR', 2), 309: ('FORECAST', 3), 311: ('INTERCEPT', 2), 312: ('PEARSON', 2),
+  313: ('RSQ', 2), 314: ('STEYX', 2), 315: ('SLOPE', 2), 318: ('DEVSQ', None),
+  319: ('GEOMEAN', None), 320: ('HARMEAN', None), 321: ('SUMSQ', None),
+  325: ('LARGE', 2), 326: ('SMALL', 2), 328: ('PERCENTILE', 2), 329: ('PERCENTRANK', None),
+  330: ('MODE', None), 336: ('CONCATENATE', None), 337: ('POWER', 2), 342: ('RADIANS', 1),
+  343: ('DEGREES', 1), 344: ('SUBTOTAL', None), 345: ('SUMIF', None), 346: ('COUNTIF', None),
+  347: ('COUNTBLANK', 1), 354: ('ROMAN', None), 358: ('GETPIVOTDATA', None),
+  359: ('HYPERLINK', None), 361: ('AVERAGEA', None), 362: ('MAXA', None),
+  363: ('MINA', None), 364: ('STDEVPA', None), 365: ('VARPA', None), 366: ('STDEVA', None),
+  367: ('VARA', None),
+}
+
+BINARY_OPERATORS = {
+  0x03: '+', 0x04: '-', 0x05: '*', 0x06: '/', 0x07: '^', 0x08: '&', 0x09: '<',
+  0x0A: '<=', 0x0B: '=', 0x0C: '>=', 0x0D: '>', 0x0E: '<>', 0x0F: ' ', 0x10: ',',
+  0x11: ':'
+}
+
+
+class FormulaError(Exception):
+  pass
+
+
+class BiffWorkbook:
+  """Globals of a BIFF8 workbook and its worksheets by name"""
+  def __init__(self, filename):
+    self.compound_file = CompoundFile(filename)
+    self.sheets = collections.OrderedDict()
+    self.all_sheet_names = []
+    self.strings = []
+    self.formats = {}
+    self.xf_formats = []
+    self.externsheets = []
+    self.supbooks = []
+    self.names = []
+    self.base_date = CALENDAR_WINDOWS_1900
+
+    try:
+      self.stream = self.compound_file.open_stream('Workbook')
+      if self.stream is None:
+        if 'Book' in self.compound_file.entries:
+          raise BiffError('{0}: BIFF5 and older workbooks are not supported'.format(filename))
+        raise BiffError('{0}: no workbook stream'.format(filename))
+      self.read_globals()
+    except Exception:
+      self.compound_file.close()
+      raise
+
+  def close(self):
+    """Close the file, the sheets can't be read any more"""
+    self.compound_file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def read_globals(self):
+    records = iter_records(self.stream)
+    type_, data = next(records, (None, b''))
+    if type_ != BOF or struct.unpack_from('<H', data)[0] != 0x0600:
+      raise BiffError('no BIFF8 workbook globals')
+
+    boundsheets = []
+    pending = None
+    for type_, data in records:
+      if type_ == CONTINUE and pending:
+        pending[1].append(data)
+        continue
+      if pending:
+        self.read_global(pending[0], pending[1])
+        pending = None
+
+      if type_ == EOF:
+        break
+      elif type_ == FILEPASS:
+        raise BiffError('encrypted workbooks are not supported')
+      elif type_ == BOUNDSHEET:
+        position, visibility, sheet_type = struct.unpack_from('<IBB', data)
+        name, _ = unicode_string(data, 6, 1)
+        self.all_sheet_names.append(name)
+        if sheet_type == 0:
+          boundsheets.append((name, position))
+      elif type_ in (SST, SUPBOOK, EXTERNSHEET, NAME):
+        pending = (type_, [data])
+      elif type_ == DATEMODE:
+        self.base_date = struct.unpack('<H', data)[0] and CALENDAR_MAC_1904 or CALENDAR_WINDOWS_1900
+      elif type_ == FORMAT:
+        index = struct.unpack_from('<H', data)[0]
+        self.formats[index], _ = unicode_string(data, 2)
+      elif type_ == XF:
+        self.xf_formats.append(struct.unpack_from('<H', data, 2)[0])
+
+    for name, position in boundsheets:
+      self.sheets[name] = BiffSheet(self, name, position)
+
+  def read_global(self, type_, parts):
+    if type_ == SST:
+      reader = Unicode(parts)
+      count = struct.unpack('<II', reader.read(8))[1]
+      self.strings = [reader.read_string() for _ in range(count)]
+    elif type_ == SUPBOOK:
+      data = b''.join(parts)
+      # the supporting link of the workbook itself is marked by 0x0401
+      self.supbooks.append(data[2:4] == b'\x01\x04')
+    elif type_ == EXTERNSHEET:
+      data = b''.join(parts)
+      count = struct.unpack_from('<H', data)[0]
+      self.externsheets = [struct.unpack_from('<HHH', data, 2+6*k) for k in range(count)]
+    elif type_ == NAME:
+      data = b''.join(parts)
+      options, _, length = struct.unpack_from('<HBB', data)
+      wide = data[14] & 0x01
+      name = data[15:15+length*(wide and 2 or 1)].decode(wide and 'utf-16-le' or 'latin-1')
+      if options & 0x20 and len(name) == 1:
+        # built-in names like Print_Area are stored as a single code
+        name = '_xlnm.' + str(ord(name))
+      self.names.append(name)
+
+  def is_date(self, xf):
+    """Return True if cells formatted with XF index xf show dates"""
+    if xf >= len(self.xf_formats):
+      return False
+    index = self.xf_formats[xf]
+    fmt = self.formats.get(index) or BUILTIN_FORMATS.get(index, 'General')
+    return is_date_format(fmt)
+
+  def sheet_reference(self, ixti):
+    """Return quoted sheet name of EXTERNSHEET entry ixti, None if it does
+    not refer to sheets of this workbook"""
+    if ixti >= len(self.externsheets):
+      return None
+    supbook, first, last = self.externsheets[ixti]
+    names = self.all_sheet_names
+    if supbook >= len(self.supbooks) or not self.supbooks[supbook] or first >= len(names):
+      return None
+    if last != first and last < len(names):
+      return quote_sheet_name(names[first] + ':' + names[last])
+    return quote_sheet_name(names[first])
+
+  def get_sheet_names(self):
+    return list(self.sheets)
+
+  def __getitem__(self, name):
+    return self.sheets[name]
+
+
+class BiffCell:
+  __slots__ = ('value', 'formula')
+
+  def __init__(self, value=None, formula=None):
+    self.value = value
+    self.formula = formula
+
+
+EMPTY_CELL = BiffCell()
+
+
+class BiffSheet:
+  """Worksheet substream of a BiffWorkbook, parsed on iteration"""
+  def __init__(self, workbook, title, position):
+    self.parent = workbook
+    self.title = title
+    self.position = position
+
+  def iter_rows(self):
+    return self.get_squared_range(1, 1, None, None)
+
+  def get_squared_range(self, min_col, min_row, max_col, max_row):
+    """Return generator for rows (tuples of cells) of the one based range,
+    open if max_col or max_row are None, as ReadOnlyWorksheet does"""
+    row_counter = min_row - 1
+    for row, cells in self.iter_cell_rows():
+      if max_row is not None and row >= max_row:
+        break
+      if row < min_row - 1:
+        continue
+
+      while row_counter < row:
+        yield self.pad((), min_col, max_col)
+        row_counter += 1
+      yield self.pad(cells, min_col, max_col)
+      row_counter += 1
+
+    if max_row is not None:
+      while row_counter < max_row:
+        yield self.pad((), min_col, max_col)
+        row_counter += 1
+
+  def pad(self, cells, min_col, max_col):
+    """Return tuple of the cells of a row (dict column -> cell) in range"""
+    if max_col is None:
+      max_col = cells and max(cells)+1 or 0
+    return tuple(cells and cells.get(column, EMPTY_CELL) or EMPTY_CELL for column in range(min_col-1, max_col))
+
+  def iter_cell_rows(self):
+    """Return generator for tuples (row, dict column -> cell) in row order.
+
+    Cells of a row block of up to 32 rows are collected until the DBCELL
+    record ending the block, so cells need not be ordered within a block.
+    Blocks with cells of shared formulas not defined yet are held back."""
+    workbook = self.parent
+    rows = {}
+    shared = {}
+    pending = []
+    formula = None
+    # the STRING record of the result of formula and its CONTINUE records
+    string = None
+
+    def flush():
+      for row in sorted(rows):
+        yield row, rows[row]
+      rows.clear()
+
+    def put(row, column, value, formula=None, xf=None):
+      if isinstance(value, float):
+        if xf is not None and formula is None and workbook.is_date(xf):
+          value = from_excel(value, workbook.base_date)
+        else:
+          value = number(value)
+      rows.setdefault(row, {})[column] = BiffCell(value, formula)
+
+    records = iter_records(workbook.stream, self.position)
+    type_, data = next(records, (None, b''))
+    if type_ != BOF:
+      raise BiffError('no worksheet at offset {0}'.format(self.position))
+
+    for type_, data in records:
+      if type_ == CONTINUE and string is not None:
+        string.append(data)
+        continue
+      if string is not None:
+        formula[3] = Unicode(string).read_string()
+        self.put_formula(put, shared, pending, *formula)
+        formula = string = None
+
+      if type_ == CONTINUE and formula:
+        formula[-1] += data
+        continue
+
+      if formula and type_ not in (STRING, SHAREDFMLA, ARRAY, TABLE):
+        # a formula may be followed by its shared formula and the STRING
+        # record of its result
+        self.put_formula(put, shared, pending, *formula)
+        formula = None
+
+      if type_ == EOF:
+        break
+      elif type_ == DBCELL:
+        # the rows of pending cells are yielded once their formula is known
+        if not pending:
+          for item in flush():
+            yield item
+      elif type_ == LABELSST:
+        row, column, xf, index = struct.unpack_from('<HHHI', data)
+        put(row, column, workbook.strings[index])
+      elif type_ == LABEL:
+        row, column, xf = struct.unpack_from('<HHH', data)
+        put(row, column, unicode_string(data, 6)[0])
+      elif type_ == NUMBER:
+        row, column, xf, value = struct.unpack_from('<HHHd', data)
+        put(row, column, value, xf=xf)
+      elif type_ == RK:
+        row, column, xf, rk = struct.unpack_from('<HHHI', data)
+        put(row, column, float(decode_rk(rk)), xf=xf)
+      elif type_ == MULRK:
+        row, first = struct.unpack_from('<HH', data)
+        for k in range((len(data)-6) // 6):
+          xf, rk = struct.unpack_from('<HI', data, 4+6*k)
+          put(row, first+k, float(decode_rk(rk)), xf=xf)
+      elif type_ == BLANK:
+        row, column = struct.unpack_from('<HH', data)
+        put(row, column, None)
+      elif type_ == MULBLANK:
+        row, first = struct.unpack_from('<HH', data)
+        for k in range((len(data)-6) // 2):
+          put(row, first+k, None)
+      elif type_ == BOOLERR:
+        row, column, xf, value, is_error = struct.unpack_from('<HHHBB', data)
+        put(row, column, is_error and ERRORS.get(value, '#N/A') or bool(value))
+      elif type_ == FORMULA:
+        row, column, xf = struct.unpack_from('<HHH', data)
+        result = data[6:14]
+        if result[6:8] == b'\xff\xff':
+          kind = result[0]
+          if kind == 0:
+            # string result in the STRING record following
+            formula = [row, column, xf, None, data]
+            continue
+          elif kind == 1:
+            value = bool(result[2])
+          elif kind == 2:
+            value = ERRORS.get(result[2], '#N/A')
+          else:
+            value = ''
+        else:
+          value = struct.unpack('<d', result)[0]
+        formula = [row, column, xf, value, data]
+      elif type_ == STRING:
+        if formula:
+          string = [data]
+      elif type_ in (SHAREDFMLA, ARRAY):
+        first_row, last_row, first_column, last_column = struct.unpack_from('<HHBB', data)
+        offset = type_ == SHAREDFMLA and 8 or 12
+        size = struct.unpack_from('<H', data, offset)[0]
+        shared[(first_row, first_column)] = (type_, data[offset+2:offset+2+size], data[offset+2+size:])
+        self.resolve_pending(put, shared, pending)
+
+    if string is not None:
+      formula[3] = Unicode(string).read_string()
+    if formula:
+      self.put_formula(put, shared, pending, *formula)
+    for item in flush():
+      yield item
+
+  def put_formula(self, put, shared, pending, row, column, xf, value, data):
+    size = struct.unpack_from('<H', data, 20)[0]
+    tokens, extra = data[22:22+size], data[22+size:]
+
+    if tokens[:1] == b'\x01' and len(tokens) >= 5:
+      # part of a shared or array formula defined by the record following
+      master = struct.unpack_from('<HH', tokens, 1)
+      if master not in shared:
+        pending.append((row, column, xf, value, master))
+        put(row, column, value, '=', xf)
+        return
+      put(row, column, value, self.shared_formula(shared[master], master, row, column), xf)
+      return
+
+    put(row, column, value, self.decompile(tokens, extra, row, column), xf)
+
+  def resolve_pending(self, put, shared, pending):
+    for item in list(pending):
+      row, column, xf, value, master = item
+      if master in shared:
+        pending.remove(item)
+        put(row, column, value, self.shared_formula(shared[master], master, row, column), xf)
+
+  def shared_formula(self, definition, master, row, column):
+    type_, tokens, extra = definition
+    if type_ == ARRAY and (row, column) != master:
+      # as in xlsx, only the master cell of an array formula has the formula
+      return None
+    return self.decompile(tokens, extra, row, column, type_ == SHAREDFMLA)
+
+  def decompile(self, tokens, extra, row, column, shared=False):
+    """Return formula text of the parsed expression tokens of cell (row,
+    column), '=#NAME?' for formulas using unsupported tokens"""
+    try:
+      return '=' + Decompiler(self.parent, tokens, extra, row, column, shared).text()
+    except (FormulaError, struct.error, IndexError):
+      return '=#NAME?'
+
+
+class Decompiler:
+  """Turn the RPN tokens of a BIFF8 formula into A1 formula text"""
+  def __init__(self, workbook, tokens, extra, row, column, shared=False):
+    self.workbook = workbook
+    self.shared = shared
+    self.tokens = tokens
+    self.extra = extra
+    self.extra_position = 0
+    self.row = row
+    self.column = column
+
+  def cell(self, row, column_field, relative_offsets=False):
+    """Return A1 text of a cell, with offsets to the cell for RefN tokens"""
+    column = column_field & 0x3FFF
+    row_relative = column_field & 0x8000
+    column_relative = column_field & 0x4000
+
+    if relative_offsets:
+      if row_relative:
+        row = (self.row + (row - 0x10000 if row & 0x8000 else row)) & MAX_ROW
+      if column_relative:
+        offset = column & 0xFF
+        column = (self.column + (offset - 0x100 if offset & 0x80 else offset)) & MAX_COLUMN
+
+    return (
+      ('' if column_relative else '$') + column_letters(column),
+      ('' if row_relative else '$') + str(row+1)
+    )
+
+  def area(self, first_row, last_row, first_field, last_field, relative_offsets=False):
+    a_column, a_row = self.cell(first_row, first_field, relative_offsets)
+    b_column, b_row = self.cell(last_row, last_field, relative_offsets)
+
+    if first_row == 0 and last_row == MAX_ROW:
+      return a_column + ':' + b_column
+    if first_field & 0x3FFF == 0 and last_field & 0x3FFF == MAX_COLUMN:
+      return a_row + ':' + b_row
+    return a_column + a_row + ':' + b_column + b_row
+
+  def number_text(self, value):
+    value = number(value)
+    if isinstance(value, float):
+      if math.isinf(value) or math.isnan(value):
+        return '#NUM!'
+      return repr(value)
+    return str(value)
+
+  def array_constant(self):
+    """Return text of the next array constant of the extra data"""
+    extra, k = self.extra, self.extra_position
+    columns, rows = extra[k] + 1, struct.unpack_from('<H', extra, k+1)[0] + 1
+    k += 3
+
+    lines = []
+    for _ in range(rows):
+      values = []
+      for _ in range(columns):
+        kind = extra[k]
+        if kind == 0x01:
+          values.append(self.number_text(struct.unpack_from('<d', extra, k+1)[0]))
+          k += 9
+        elif kind == 0x02:
+          text, k = unicode_string(extra, k+1)
+          values.append('"{0}"'.format(text.replace('"', '""')))
+        elif kind == 0x04:
+          values.append(extra[k+1] and 'TRUE' or 'FALSE')
+          k += 9
+        elif kind == 0x10:
+          values.append(ERRORS.get(extra[k+1], '#N/A'))
+          k += 9
+        else:
+          values.append('')
+          k += 9
+      lines.append(','.join(values))
+
+    self.extra_position = k
+    return '{' + ';'.join(lines) + '}'
+
+  def text(self):
+    tokens = self.tokens
+    stack = []
+    k = 0
+
+    while k < len(tokens):
+      ptg = tokens[k]
+      base = ptg < 0x20 and ptg or (ptg & 0x1F) | 0x20
+      k += 1
+
+      if ptg in BINARY_OPERATORS:
+        b, a = stack.pop(), stack.pop()
+        stack.append(a + BINARY_OPERATORS[ptg] + b)
+      elif ptg == 0x12:
+        stack.append('+' + stack.pop())
+      elif ptg == 0x13:
+        stack.append('-' + stack.pop())
+      elif ptg == 0x14:
+        stack.append(stack.pop() + '%')
+      elif ptg == 0x15:
+        stack.append('(' + stack.pop() + ')')
+      elif ptg == 0x16:
+        stack.append('')
+      elif ptg == 0x17:
+        text, k = unicode_string(tokens, k, 1)
+        stack.append('"{0}"'.format(text.replace('"', '""')))
+      elif ptg == 0x19:
+        options, data = tokens[k], struct.unpack_from('<H', tokens, k+1)[0]
+        k += 3
+        if options & 0x04:
+          # CHOOSE jump table
+          k += (data+1) * 2
+        elif options & 0x10:
+          stack.append('SUM(' + stack.pop() + ')')
+      elif ptg == 0x1C:
+        stack.append(ERRORS.get(tokens[k], '#N/A'))
+        k += 1
+      elif ptg == 0x1D:
+        stack.append(tokens[k] and 'TRUE' or 'FALSE')
+        k += 1
+      elif ptg == 0x1E:
+        stack.append(str(struct.unpack_from('<H', tokens, k)[0]))
+        k += 2
+      elif ptg == 0x1F:
+        stack.append(self.number_text(struct.unpack_from('<d', tokens, k)[0]))
+        k += 8
+      elif base == 0x20:
+        k += 7
+        stack.append(self.array_constant())
+      elif base in (0x21, 0x22):
+        if base == 0x21:
+          index = struct.unpack_from('<H', tokens, k)[0]
+          k += 2
+          name, count = FUNCTIONS.get(index, (None, None))
+          if count is None:
+            raise FormulaError('unknown function {0}'.format(index))
+        else:
+          count, index = tokens[k] & 0x7F, struct.unpack_from('<H', tokens, k+1)[0] & 0x7FFF
+          k += 3
+          name = FUNCTIONS.get(index, (None, None))[0]
+        args = [stack.pop() for _ in range(count)][::-1]
+        if index == 255:
+          # add-in or macro function, named by its first argument
+          name, args = args[0], args[1:]
+        if name is None:
+          raise FormulaError('unknown function {0}'.format(index))
+        stack.append(name + '(' + ','.join(args) + ')')
+      elif base == 0x23:
+        index = struct.unpack_from('<H', tokens, k)[0]
+        k += 4
+        names = self.workbook.names
+        stack.append(names[index-1] if 0 < index <= len(names) else '#NAME?')
+      elif base in (0x24, 0x2C):
+        row, field = struct.unpack_from('<HH', tokens, k)
+        k += 4
+        stack.append(''.join(self.cell(row, field, base == 0x2C)))
+      elif base in (0x25, 0x2D):
+        first_row, last_row, first_field, last_field = struct.unpack_from('<HHHH', tokens, k)
+        k += 8
+        stack.append(self.area(first_row, last_row, first_field, last_field, base == 0x2D))
+      elif base == 0x26:
+        # the subexpression follows, its cached areas are in the extra data
+        k += 6
+        count = struct.unpack_from('<H', self.extra, self.extra_position)[0]
+        self.extra_position += 2 + count*8
+      elif base in (0x27, 0x28):
+        k += 6
+      elif base in (0x29, 0x2E, 0x2F):
+        k += 2
+      elif base == 0x2A:
+        k += 4
+        stack.append('#REF!')
+      elif base == 0x2B:
+        k += 8
+        stack.append('#REF!')
+      elif base == 0x39:
+        k += 6
+        stack.append('#NAME?')
+      elif base in (0x3A, 0x3B):
+        ixti = struct.unpack_from('<H', tokens, k)[0]
+        if base == 0x3A:
+          row, field = struct.unpack_from('<HH', tokens, k+2)
+          reference = ''.join(self.cell(row, field, self.shared))
+          k += 6
+        else:
+          reference = self.area(*struct.unpack_from('<HHHH', tokens, k+2), relative_offsets=self.shared)
+          k += 10
+        sheet = self.workbook.sheet_reference(ixti)
+        stack.append(sheet and sheet + '!' + reference or '#REF!')
+      elif base == 0x3C:
+        k += 6
+        stack.append('#REF!')
+      elif base == 0x3D:
+        k += 10
+        stack.append('#REF!')
+      else:
+        raise FormulaError('unknown token {0:#x}'.format(ptg))
+
+    if len(stack) != 1:
+      raise FormulaError('unbalanced formula')
+    return stack[0]
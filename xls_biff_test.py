@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import struct
+import unittest
+import xls_biff
+from xls_biff import BiffSheet, BiffWorkbook, Decompiler, Unicode, decode_rk
+
+grill = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xls', 'grill.xls')
+
+RELATIVE = 0xC000
+
+def ref(row, column, ptg=0x24):
+  return struct.pack('<BHH', ptg, row, column)
+
+def area(first_row, last_row, first_column, last_column, ptg=0x25):
+  return struct.pack('<BHHHH', ptg, first_row, last_row, first_column, last_column)
+
+def func_var(index, count):
+  return struct.pack('<BBH', 0x22, count, index)
+
+def record(type_, data):
+  return struct.pack('<HH', type_, len(data)) + data
+
+def formula(row, column, tokens, result=struct.pack('<d', 0)):
+  return record(xls_biff.FORMULA, struct.pack('<HHH', row, column, 0) + result + bytes(6) + struct.pack('<H', len(tokens)) + tokens)
+
+
+class Workbook:
+  """Sheet stream of records without any globals"""
+  strings = []
+  base_date = None
+
+  def __init__(self, *records):
+    self.stream = io.BytesIO(record(xls_biff.BOF, bytes(16)) + b''.join(records) + record(xls_biff.EOF, b''))
+
+  def is_date(self, xf):
+    return False
+
+
+class Formulas(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.workbook = BiffWorkbook(grill)
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.workbook.close()
+
+  def decompile(self, tokens, row=0, column=0, shared=False):
+    return Decompiler(self.workbook, tokens, b'', row, column, shared).text()
+
+  def test_references(self):
+    self.assertEqual('SUM(B3:H3)*2', self.decompile(
+      area(2, 2, 1|RELATIVE, 7|RELATIVE) + func_var(4, 1) + struct.pack('<BH', 0x1E, 2) + b'\x05'
+    ))
+    self.assertEqual('$A$1+B$2', self.decompile(ref(0, 0) + ref(1, 1|0x4000) + b'\x03'))
+    self.assertEqual('SUM(A:B)', self.decompile(area(0, 0xFFFF, RELATIVE, 1|RELATIVE) + func_var(4, 1)))
+    self.assertEqual('\'Income Statement\'!A1', self.decompile(struct.pack('<BHHH', 0x3A, 1, 0, RELATIVE)))
+
+  def test_shared_references(self):
+    # one row up, one column right of the cell E6
+    self.assertEqual('F5', self.decompile(ref(0xFFFF, 1|RELATIVE, 0x2C), 5, 4, True))
+    self.assertEqual('$A$1:F7', self.decompile(area(0, 1, 0|0x0000, 1|RELATIVE, 0x2D), 5, 4, True))
+
+  def test_operators(self):
+    text = struct.pack('<BBB', 0x17, 3, 0) + b'a"b'
+    self.assertEqual('-("a""b"&1.5)%', self.decompile(
+      text + struct.pack('<Bd', 0x1F, 1.5) + b'\x08\x15\x13\x14'
+    ))
+
+
+class Records(unittest.TestCase):
+  def test_rk(self):
+    self.assertEqual(1, decode_rk((1 << 2) | 0x02))
+    self.assertEqual(1.5, decode_rk((150 << 2) | 0x03))
+    self.assertEqual(-2, decode_rk(((-2 & 0x3FFFFFFF) << 2) | 0x02))
+    self.assertEqual(0.5, decode_rk(struct.unpack('<Q', struct.pack('<d', 0.5))[0] >> 32))
+
+  def test_continued_string(self):
+    # five characters, split after two single byte ones, continued wide
+    parts = [struct.pack('<HB', 5, 0) + b'ab', b'\x01' + 'cde'.encode('utf-16-le')]
+    self.assertEqual('abcde', Unicode(parts).read_string())
+
+  def test_workbook(self):
+    with BiffWorkbook(grill) as workbook:
+      self.assertEqual(13, len(workbook.get_sheet_names()))
+      rows = list(workbook['Income Statement'].iter_rows())
+    self.assertTrue(workbook.compound_file.file.closed)
+    self.assertEqual(
+      'Chipotle Mexican Grill, Inc. (NYSE:CMG) > Financials > Income Statement',
+      rows[4][0].value
+    )
+
+
+
+class Sheets(unittest.TestCase):
+  def rows(self, *records):
+    return [
+      (row, {column: (cell.value, cell.formula) for column, cell in cells.items()})
+      for row, cells in BiffSheet(Workbook(*records), 'Sheet1', 0).iter_cell_rows()
+    ]
+
+  def test_continued_string_result(self):
+    # five characters, the last three in a CONTINUE record
+    self.assertEqual([(0, {0: ('abcde', '=1')}), (1, {0: (2, None)})], self.rows(
+      formula(0, 0, struct.pack('<BH', 0x1E, 1), b'\x00' + bytes(5) + b'\xff\xff'),
+      record(xls_biff.STRING, struct.pack('<HB', 5, 0) + b'ab'),
+      record(xls_biff.CONTINUE, b'\x00cde'),
+      record(xls_biff.NUMBER, struct.pack('<HHHd', 1, 0, 0, 2.0)),
+    ))
+
+  def test_shared_formula_after_row_block(self):
+    # the SHAREDFMLA record of A1 only follows in the next row block
+    self.assertEqual([(0, {0: (0, '=1')}), (1, {0: (2, None)})], self.rows(
+      formula(0, 0, struct.pack('<BHH', 0x01, 0, 0)),
+      record(xls_biff.DBCELL, bytes(4)),
+      record(xls_biff.NUMBER, struct.pack('<HHHd', 1, 0, 0, 2.0)),
+      record(xls_biff.SHAREDFMLA, struct.pack('<HHBBBBH', 0, 1, 0, 0, 0, 2, 3) + struct.pack('<BH', 0x1E, 1)),
+      record(xls_biff.DBCELL, bytes(4)),
+    ))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,730 @@
+#!/usr/bin/env python3
+
+"""Recalculation of the formulas of a loaded workbook.
+
+Formulas are parsed by tokenizer.shunting_yard and compiled once per
+distinct text and sheet into a list of instructions for a small stack
+machine. The cells they reference span a dependency graph, which is
+topologically ordered so every formula is evaluated after the formulas it
+depends on. Ranges are evaluated row by row as slices of the flat value
+lists of the sheets."""
+
+import re
+import math
+import inspect
+import heapq
+import bisect
+import datetime
+import collections
+
+from openpyxl.utils.datetime import to_excel, time_to_days
+from tokenizer import ExcelParser, shunting_yard_batch, RangeNode, FunctionNode
+
+
+ERROR_VALUES = ('#NULL!', '#DIV/0!', '#VALUE!', '#REF!', '#NAME?', '#NUM!', '#N/A')
+
+CELL_RANGE = re.compile(r'\$?([A-Z]{1,3})\$?([0-9]+)(?::\$?([A-Z]{1,3})\$?([0-9]+))?$')
+COLUMN_RANGE = re.compile(r'\$?([A-Z]{1,3}):\$?([A-Z]{1,3})$')
+ROW_RANGE = re.compile(r'\$?([0-9]+):\$?([0-9]+)$')
+
+NUMBER = (int, float)
+# date cells as loaded by openpyxl and xls_biff, numbers to formulas
+DATES = (datetime.datetime, datetime.date, datetime.time)
+NUMERIC_TEXT = re.compile(r'\s*[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?\s*$')
+
+
+class Error(str):
+  """Excel error value such as #DIV/0!"""
+  __slots__ = ()
+
+NULL, DIV0, VALUE, REF, NAME, NUM, NA = [Error(e) for e in ERROR_VALUES]
+
+
+class Range:
+  """Rectangular range of cells of a sheet, zero based and inclusive"""
+  __slots__ = ('sheet_name', 'top', 'left', 'bottom', 'right')
+
+  def __init__(self, sheet_name, top, left, bottom, right):
+    self.sheet_name = sheet_name
+    self.top, self.left, self.bottom, self.right = top, left, bottom, right
+
+  def cells(self):
+    return (self.bottom-self.top+1) * (self.right-self.left+1)
+
+  def __repr__(self):
+    return 'Range({0!r}, {1}, {2}, {3}, {4})'.format(
+      self.sheet_name, self.top, self.left, self.bottom, self.right
+    )
+
+
+def column_index(letters):
+  """Return zero based index of column letters"""
+  index = 0
+  for letter in letters:
+    index = index*26 + ord(letter) - 64
+  return index - 1
+
+
+def to_number(value):
+  """Return value as number for arithmetic, or an Error"""
+  t = type(value)
+  if t is int or t is float:
+    return value
+  if value is None:
+    return 0
+  if t is bool:
+    return int(value)
+  if t is Error:
+    return value
+  if t in DATES:
+    return serial_number(value)
+  # float() would also accept 'nan', 'inf' and '1_0'
+  if t is str and NUMERIC_TEXT.match(value):
+    return finite(float(value))
+  return VALUE
+
+
+def serial_number(value):
+  """Return the serial number of date, datetime or time value, days since
+  1900-01-00 (as if 1900 was a leap year)"""
+  if type(value) is datetime.time:
+    return time_to_days(value)
+  return to_excel(value)
+
+
+def finite(value):
+  """Return value, #NUM! if it is an infinite or nan float"""
+  if type(value) is float and not math.isfinite(value):
+    return NUM
+  return value
+
+
+def empty_arguments(text):
+  """Return whether formula text passes an empty argument to a function"""
+  previous = None
+  for token in ExcelParser().getTokens(text).items:
+    if previous is not None and (
+      (token.ttype == 'argument' and (previous.ttype == 'argument' or previous.tsubtype == 'start')) or
+      (token.tsubtype == 'stop' and previous.ttype == 'argument')
+    ):
+      return True
+    previous = token
+  return False
+
+
+def to_bool(value):
+  """Return value as condition, or an Error"""
+  t = type(value)
+  if t is bool or t is Error:
+    return value
+  if value is None:
+    return False
+  if t is int or t is float:
+    return value != 0
+  if t in DATES:
+    return serial_number(value) != 0
+  upper = str(value).upper()
+  if upper in ('TRUE', 'FALSE'):
+    return upper == 'TRUE'
+  return VALUE
+
+
+def to_text(value):
+  """Return value as text for concatenation"""
+  if value is None:
+    return ''
+  if type(value) is bool:
+    return value and 'TRUE' or 'FALSE'
+  if type(value) is float and value.is_integer():
+    return str(int(value))
+  return str(value)
+
+
+def compare_key(value):
+  """Return key ordering values as Excel: numbers (and dates), texts
+  (case-insensitive) and logical values"""
+  t = type(value)
+  if t is bool:
+    return (2, value)
+  if t is int or t is float:
+    return (0, value)
+  if t in DATES:
+    return (0, serial_number(value))
+  return (1, str(value).lower())
+
+
+def compare(op, a, b):
+  if type(a) is Error:
+    return a
+  if type(b) is Error:
+    return b
+
+  # an empty cell is 0, '' or FALSE, whatever it is compared with
+  if a is None:
+    a = empty_like(b)
+  if b is None:
+    b = empty_like(a)
+
+  a, b = compare_key(a), compare_key(b)
+  if op == '=':
+    return a == b
+  if op == '<>':
+    return a != b
+  if op == '<':
+    return a < b
+  if op == '>':
+    return a > b
+  if op == '<=':
+    return a <= b
+  return a >= b
+
+
+def is_text(value):
+  return isinstance(value, str) and type(value) is not Error
+
+
+def empty_like(value):
+  """Return the value of an empty cell compared with value"""
+  if type(value) is bool:
+    return False
+  if is_text(value):
+    return ''
+  return 0
+
+
+def same(a, b):
+  """Return whether a and b are the same value, 1 and 1.0 being the same"""
+  return a == b and (type(a) is bool) == (type(b) is bool) and \
+    (type(a) is Error) == (type(b) is Error)
+
+
+def arithmetic(op, a, b):
+  a, b = to_number(a), to_number(b)
+  if type(a) is Error:
+    return a
+  if type(b) is Error:
+    return b
+
+  if op == '+':
+    return finite(a + b)
+  if op == '-':
+    return finite(a - b)
+  if op == '*':
+    return finite(a * b)
+  if op == '/':
+    return finite(a / b) if b else DIV0
+  try:
+    result = math.pow(a, b)
+  except ZeroDivisionError:
+    return DIV0
+  except (OverflowError, ValueError):
+    return NUM
+  return result
+
+
+class Evaluator:
+  """Formula engine over the sheet grids of a WorkbookModel.
+
+  Cells are tuples (sheet_name, row, column) of zero based offsets. Values
+  start as the values loaded from the file. Only formulas without a loaded
+  value and the formulas depending on cells changed by set_value() are
+  dirty, recalculate() evaluates them in dependency order and reuses the
+  values of all others. recalculate_all() evaluates every formula.
+
+  Formulas using functions, operators or names not supported here (listed
+  in unsupported) and formulas on circular references (listed in circular)
+  keep their loaded values."""
+
+  def __init__(self, workbook_model):
+    self.grids = workbook_model.sheet_grids
+    self.values = {}
+    self.formulas = {}
+    self.codes = {}
+    self.unsupported = []
+    self.dirty = set()
+    self.readers = {}
+    for sheet_name in workbook_model.sheet_names():
+      grid = self.grids[sheet_name]
+      self.values[sheet_name] = [
+        Error(value) if value in ERROR_VALUES else value for value in grid.values
+      ]
+      for k, text in enumerate(grid.formulas):
+        # unresolvable formulas were marked as text by calculate_references,
+        # losing their loaded values
+        if text and is_text(text) and text.lstrip('\'').startswith('='):
+          cell = (sheet_name,) + divmod(k, grid.column_count)
+          self.formulas[cell] = text.lstrip('\'')
+          if text.startswith('\'') or grid.values[k] is None:
+            self.dirty.add(cell)
+
+    self.compile()
+    self.build_graph()
+    self.dirty.intersection_update(self.position)
+
+  def compile(self):
+    """Compile the formulas, once per distinct text and sheet"""
+    parsed = shunting_yard_batch(
+      ((cell[0], text) for cell, text in self.formulas.items())
+    )
+    compiled = {}
+    for cell, (sheet_name, rpn) in zip(self.formulas, parsed):
+      key = (sheet_name, self.formulas[cell])
+      if key not in compiled:
+        # the rpn doesn't count empty arguments like in IF(A1,,1)
+        compiled[key] = None if empty_arguments(key[1]) else self.compile_rpn(sheet_name, rpn)
+      if compiled[key] is None:
+        self.unsupported.append(cell)
+      else:
+        self.codes[cell] = compiled[key]
+
+  def compile_rpn(self, sheet_name, rpn):
+    """Return tuple of instructions (kind, argument) for rpn on sheet_name,
+    None if it can't be evaluated or leaves other than one value"""
+    code = []
+    for node in rpn:
+      token = node.token
+      if isinstance(node, RangeNode):
+        reference = self.parse_range(sheet_name, token.tvalue)
+        if reference is None:
+          return None
+        code.append(('push', reference))
+      elif isinstance(node, FunctionNode):
+        name = token.tvalue.upper()
+        if name not in FUNCTIONS:
+          return None
+        least, most = ARITY[name]
+        if node.num_args < least or (most is not None and node.num_args > most):
+          return None
+        code.append(('call', (name, node.num_args)))
+      elif token.ttype == 'operand':
+        if token.tsubtype == 'number':
+          code.append(('push', finite(float(token.tvalue))))
+        elif token.tsubtype == 'logical':
+          code.append(('push', token.tvalue == 'TRUE'))
+        elif token.tsubtype == 'error':
+          code.append(('push', Error(token.tvalue)))
+        else:
+          code.append(('push', token.tvalue))
+      elif token.ttype == 'operator-prefix':
+        code.append(('negate', None))
+      elif token.ttype == 'operator-postfix':
+        code.append(('percent', None))
+      elif token.ttype == 'operator-infix' and token.tsubtype in ('math', 'logical', 'concatenate'):
+        code.append(('infix', token.tvalue))
+      else:
+        # range operators, intersections and unions
+        return None
+
+    # the operands each instruction pops and the values it pushes
+    depth = 0
+    for kind, argument in code:
+      if kind == 'call':
+        taken = argument[1]
+      else:
+        taken = {'push': 0, 'infix': 2}.get(kind, 1)
+      if depth < taken:
+        return None
+      depth += 1 - taken
+    return tuple(code) if depth == 1 else None
+
+  def parse_range(self, sheet_name, text):
+    """Return Range of reference text on sheet_name, #REF! for unknown
+    sheets or None for names and references to other workbooks"""
+    if '!' in text:
+      sheet_name, _, text = text.rpartition('!')
+      if sheet_name.startswith("'") and sheet_name.endswith("'"):
+        sheet_name = sheet_name[1:-1].replace("''", "'")
+      # [1]Sheet!A1, the loaded value is kept instead
+      if '[' in sheet_name:
+        return None
+    grid = self.grids.get(sheet_name)
+    if grid is None:
+      return REF
+
+    m = CELL_RANGE.match(text)
+    if m:
+      top, left = int(m.group(2))-1, column_index(m.group(1))
+      if m.group(3):
+        bottom, right = int(m.group(4))-1, column_index(m.group(3))
+      else:
+        bottom, right = top, left
+      return Range(sheet_name, min(top, bottom), min(left, right), max(top, bottom), max(left, right))
+
+    m = COLUMN_RANGE.match(text)
+    if m:
+      left, right = sorted([column_index(m.group(1)), column_index(m.group(2))])
+      return Range(sheet_name, 0, left, max(grid.row_count-1, 0), right)
+
+    m = ROW_RANGE.match(text)
+    if m:
+      top, bottom = sorted([int(m.group(1))-1, int(m.group(2))-1])
+      return Range(sheet_name, top, 0, bottom, max(grid.column_count-1, 0))
+
+    # defined names are not supported
+    return None
+
+  def build_graph(self):
+    """Link every formula to the formulas in the ranges it references and
+    order them topologically"""
+    rows = {}
+    for sheet_name, row, column in self.codes:
+      rows.setdefault(sheet_name, {}).setdefault(row, []).append(column)
+    sorted_rows = dict((sheet_name, sorted(r)) for sheet_name, r in rows.items())
+
+    self.precedents = {}
+    self.dependents = collections.defaultdict(list)
+    self.ranges = collections.defaultdict(list)
+    for cell, code in self.codes.items():
+      precedents = set()
+      for kind, argument in code:
+        if kind != 'push' or type(argument) is not Range:
+          continue
+        self.ranges[argument.sheet_name].append((argument, cell))
+        if argument.sheet_name not in rows:
+          continue
+        sheet_rows, columns = sorted_rows[argument.sheet_name], rows[argument.sheet_name]
+        a = bisect.bisect_left(sheet_rows, argument.top)
+        b = bisect.bisect_right(sheet_rows, argument.bottom)
+        for row in sheet_rows[a:b]:
+          for column in columns[row]:
+            if argument.left <= column <= argument.right:
+              precedents.add((argument.sheet_name, row, column))
+      self.precedents[cell] = precedents
+      for precedent in precedents:
+        self.dependents[precedent].append(cell)
+
+    # Kahn's algorithm, the cells left over are on or behind a cycle
+    pending = dict((cell, len(precedents)) for cell, precedents in self.precedents.items())
+    ready = collections.deque(cell for cell, count in pending.items() if count == 0)
+    self.order = []
+    while ready:
+      cell = ready.popleft()
+      self.order.append(cell)
+      for dependent in self.dependents.get(cell, ()):
+        pending[dependent] -= 1
+        if pending[dependent] == 0:
+          ready.append(dependent)
+
+    self.position = dict((cell, k) for k, cell in enumerate(self.order))
+    self.circular = [cell for cell in self.codes if cell not in self.position]
+
+  def value(self, sheet_name, row, column):
+    """Return current value of a cell, None outside of its sheet"""
+    grid = self.grids[sheet_name]
+    if row >= grid.row_count or column >= grid.column_count:
+      return None
+    return self.values[sheet_name][grid.offset(row, column)]
+
+  def range_rows(self, r):
+    """Return list of the value lists of the rows of range r, cells outside
+    of the sheet being None"""
+    grid, values = self.grids[r.sheet_name], self.values[r.sheet_name]
+    width = r.right - r.left + 1
+    present = max(min(r.right, grid.column_count-1) - r.left + 1, 0)
+    missing = [None] * (width - present)
+
+    rows = []
+    for row in range(r.top, min(r.bottom, grid.row_count-1)+1):
+      a = grid.offset(row, r.left)
+      rows.append(values[a:a+present] + missing)
+    rows += [[None] * width] * (r.bottom - r.top + 1 - len(rows))
+    return rows
+
+  def scalar(self, value):
+    """Return value of a single cell range, other ranges are #VALUE!"""
+    if type(value) is not Range:
+      return value
+    if value.cells() != 1:
+      return VALUE
+    return self.value(value.sheet_name, value.top, value.left)
+
+  def evaluate(self, cell):
+    """Evaluate the formula of cell and return its value"""
+    stack = []
+    for kind, argument in self.codes[cell]:
+      if kind == 'push':
+        stack.append(argument)
+      elif kind == 'infix':
+        b = self.scalar(stack.pop())
+        a = self.scalar(stack.pop())
+        if argument == '&':
+          if type(a) is Error or type(b) is Error:
+            stack.append(a if type(a) is Error else b)
+          else:
+            stack.append(to_text(a) + to_text(b))
+        elif argument in ('+', '-', '*', '/', '^'):
+          stack.append(arithmetic(argument, a, b))
+        else:
+          stack.append(compare(argument, a, b))
+      elif kind == 'call':
+        name, count = argument
+        arguments = stack[len(stack)-count:]
+        del stack[len(stack)-count:]
+        stack.append(finite(FUNCTIONS[name](self, *arguments)))
+      elif kind == 'negate':
+        a = to_number(self.scalar(stack.pop()))
+        stack.append(a if type(a) is Error else -a)
+      else:
+        a = to_number(self.scalar(stack.pop()))
+        stack.append(a if type(a) is Error else a / 100.0)
+
+    if len(stack) != 1:
+      return VALUE
+    value = self.scalar(stack[0])
+    return 0 if value is None else value
+
+  def cell_readers(self, cell):
+    """Return list of the evaluated formulas referencing cell"""
+    readers = self.readers.get(cell)
+    if readers is None:
+      sheet_name, row, column = cell
+      readers = [
+        reader for r, reader in self.ranges.get(sheet_name, ())
+        if r.top <= row <= r.bottom and r.left <= column <= r.right and reader in self.position
+      ]
+      self.readers[cell] = readers
+    return readers
+
+  def set_value(self, sheet_name, row, column, value):
+    """Change the value of a cell, the formulas depending on it become dirty.
+    Return whether the value changed, raise ValueError for formula cells"""
+    grid = self.grids[sheet_name]
+    if row >= grid.row_count or column >= grid.column_count:
+      raise IndexError('cell ({0}, {1}) is outside of sheet {2!r}'.format(row, column, sheet_name))
+    if (sheet_name, row, column) in self.formulas:
+      # recalculate() would overwrite the value again
+      raise ValueError('cell ({0}, {1}) of sheet {2!r} is a formula'.format(row, column, sheet_name))
+
+    values, k = self.values[sheet_name], grid.offset(row, column)
+    if same(value, values[k]):
+      return False
+    values[k] = value
+    self.dirty.update(self.cell_readers((sheet_name, row, column)))
+    return True
+
+  def recalculate(self):
+    """Evaluate the dirty formulas and, as far as their values changed, the
+    formulas depending on them, in dependency order. Return list of the
+    cells whose values changed"""
+    # the dirty formulas are kept sorted by their position in self.order
+    pending = [(self.position[cell], cell) for cell in self.dirty]
+    heapq.heapify(pending)
+    queued = set(self.dirty)
+    self.dirty.clear()
+
+    changed = []
+    while pending:
+      _, cell = heapq.heappop(pending)
+      sheet_name, row, column = cell
+      values, k = self.values[sheet_name], self.grids[sheet_name].offset(row, column)
+      value = self.evaluate(cell)
+      if same(value, values[k]):
+        continue
+
+      values[k] = value
+      changed.append(cell)
+      for reader in self.dependents.get(cell, ()):
+        if reader not in queued and reader in self.position:
+          queued.add(reader)
+          heapq.heappush(pending, (self.position[reader], reader))
+
+    return changed
+
+  def recalculate_all(self):
+    """Evaluate all formulas. Return list of the cells whose values changed"""
+    self.dirty.update(self.order)
+    return self.recalculate()
+
+
+# functions get the evaluator and their arguments, ranges unevaluated
+
+def numbers(evaluator, arguments):
+  """Return list of the numbers of arguments as SUM sees them: numbers of
+  ranges, other arguments converted. An error is returned instead"""
+  result = []
+  for argument in arguments:
+    if type(argument) is Range:
+      for row in evaluator.range_rows(argument):
+        for value in row:
+          t = type(value)
+          if t is int or t is float:
+            result.append(value)
+          elif t in DATES:
+            result.append(serial_number(value))
+          elif t is Error:
+            return value
+    else:
+      value = to_number(argument)
+      if type(value) is Error:
+        return value
+      result.append(value)
+  return result
+
+def function_sum(evaluator, *arguments):
+  values = numbers(evaluator, arguments)
+  return values if type(values) is Error else sum(values)
+
+def function_average(evaluator, *arguments):
+  values = numbers(evaluator, arguments)
+  if type(values) is Error:
+    return values
+  return sum(values) / len(values) if values else DIV0
+
+def function_min(evaluator, *arguments):
+  values = numbers(evaluator, arguments)
+  return values if type(values) is Error else min(values or [0])
+
+def function_max(evaluator, *arguments):
+  values = numbers(evaluator, arguments)
+  return values if type(values) is Error else max(values or [0])
+
+def function_count(evaluator, *arguments):
+  count = 0
+  for argument in arguments:
+    if type(argument) is Range:
+      count += sum(type(value) in NUMBER or type(value) in DATES
+        for row in evaluator.range_rows(argument) for value in row)
+    else:
+      count += type(to_number(argument)) in NUMBER
+  return count
+
+def function_if(evaluator, condition, if_true, if_false=False):
+  condition = to_bool(evaluator.scalar(condition))
+  if type(condition) is Error:
+    return condition
+  return if_true if condition else if_false
+
+def function_iferror(evaluator, value, alternative):
+  return alternative if type(evaluator.scalar(value)) is Error else value
+
+def function_and(evaluator, *arguments):
+  return logical(evaluator, arguments, all)
+
+def function_or(evaluator, *arguments):
+  return logical(evaluator, arguments, any)
+
+def logical(evaluator, arguments, combine):
+  conditions = []
+  for argument in arguments:
+    if type(argument) is Range:
+      # texts and empty cells of ranges are ignored
+      values = [v for row in evaluator.range_rows(argument) for v in row if v is not None and not is_text(v)]
+    else:
+      values = [evaluator.scalar(argument)]
+    for value in values:
+      value = to_bool(value)
+      if type(value) is Error:
+        return value
+      conditions.append(value)
+  return combine(conditions) if conditions else VALUE
+
+def function_not(evaluator, value):
+  value = to_bool(evaluator.scalar(value))
+  return value if type(value) is Error else not value
+
+def function_abs(evaluator, value):
+  value = to_number(evaluator.scalar(value))
+  return value if type(value) is Error else abs(value)
+
+def function_round(evaluator, value, digits):
+  value, digits = to_number(evaluator.scalar(value)), to_number(evaluator.scalar(digits))
+  if type(value) is Error or type(digits) is Error:
+    return value if type(value) is Error else digits
+  if not math.isfinite(value) or not math.isfinite(digits):
+    return NUM
+
+  # halves are rounded away from zero
+  digits = max(min(int(digits), 308), -308)
+  scale = math.pow(10, abs(digits))
+  if digits < 0:
+    return math.copysign(math.floor(abs(value) / scale + 0.5) * scale, value)
+  scaled = abs(value) * scale
+  if not math.isfinite(scaled) or scaled >= 2**52:
+    # no fractional digits left to round
+    return value
+  return math.copysign(math.floor(scaled + 0.5) / scale, value)
+
+def function_index(evaluator, reference, row, column=None):
+  # a single row is indexed by its columns if no column is given
+  if column is None and type(reference) is Range and reference.top == reference.bottom:
+    row, column = 1, row
+
+  row = to_number(evaluator.scalar(row))
+  column = to_number(evaluator.scalar(0 if column is None else column))
+  if type(row) is Error or type(column) is Error:
+    return row if type(row) is Error else column
+  row, column = int(row), int(column)
+
+  if type(reference) is not Range:
+    return reference if row <= 1 and column <= 1 else REF
+
+  height = reference.bottom - reference.top + 1
+  width = reference.right - reference.left + 1
+  if row < 0 or column < 0 or row > height or column > width:
+    return REF
+
+  top, bottom = (reference.top, reference.bottom) if row == 0 else (reference.top+row-1,)*2
+  left, right = (reference.left, reference.right) if column == 0 else (reference.left+column-1,)*2
+  return Range(reference.sheet_name, top, left, bottom, right)
+
+def function_match(evaluator, lookup, reference, match_type=1):
+  lookup = evaluator.scalar(lookup)
+  match_type = to_number(evaluator.scalar(match_type))
+  if type(lookup) is Error:
+    return lookup
+  if type(match_type) is Error:
+    return match_type
+
+  if type(reference) is Range:
+    if reference.top != reference.bottom and reference.left != reference.right:
+      return NA
+    values = [value for row in evaluator.range_rows(reference) for value in row]
+  else:
+    values = [reference]
+
+  if lookup is None:
+    lookup = 0
+  key = compare_key(lookup)
+  found = None
+  for position, value in enumerate(values):
+    if value is None or type(value) is Error or compare_key(value)[0] != key[0]:
+      continue
+    value = compare_key(value)
+    if match_type == 0:
+      if value == key:
+        return position + 1
+    elif (match_type > 0 and value <= key) or (match_type < 0 and value >= key):
+      found = position + 1
+    else:
+      # the values are expected to be sorted
+      break
+  return NA if found is None else found
+
+
+FUNCTIONS = {
+  'SUM': function_sum,
+  'AVERAGE': function_average,
+  'MIN': function_min,
+  'MAX': function_max,
+  'COUNT': function_count,
+  'IF': function_if,
+  'IFERROR': function_iferror,
+  'AND': function_and,
+  'OR': function_or,
+  'NOT': function_not,
+  'ABS': function_abs,
+  'ROUND': function_round,
+  'INDEX': function_index,
+  'MATCH': function_match,
+}
+
+
+def arity(function):
+  """Return tuple (least, most) number of arguments of function, most being
+  None if unlimited"""
+  parameters = list(inspect.signature(function).parameters.values())[1:]
+  if any(p.kind == p.VAR_POSITIONAL for p in parameters):
+    return (0, None)
+  return (len([p for p in parameters if p.default is p.empty]), len(parameters))
+
+ARITY = dict((name, arity(function)) for name, function in FUNCTIONS.items())
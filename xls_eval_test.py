@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+import os
+import datetime
+import unittest
+from xls_model import SheetGrid, WorkbookModel
+from xls_eval import Evaluator, Error
+from tokenizer import shunting_yard
+
+funds = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xls', 'funds.xlsx')
+
+
+def workbook(**sheets):
+  """Return WorkbookModel of sheets given as lists of rows, cells starting
+  with '=' being formulas without loaded value"""
+  workbook_model = WorkbookModel()
+  for sheet_name, rows in sorted(sheets.items()):
+    grid = SheetGrid(sheet_name)
+    grid.row_count, grid.column_count = len(rows), max(len(row) for row in rows)
+    for row in rows:
+      row = row + [None] * (grid.column_count - len(row))
+      grid.values += [None if type(cell) is str and cell.startswith('=') else cell for cell in row]
+      grid.formulas += [cell if type(cell) is str and cell.startswith('=') else None for cell in row]
+    workbook_model.names.append(sheet_name)
+    workbook_model.sheet_grids[sheet_name] = grid
+  return workbook_model
+
+
+class Recalculate(unittest.TestCase):
+  def test_loaded_values(self):
+    workbook_model = WorkbookModel()
+    workbook_model.load_file(funds, jobs=1)
+    evaluator = Evaluator(workbook_model)
+    self.assertTrue(evaluator.order)
+    self.assertEqual([], evaluator.recalculate_all())
+
+  def test_incremental(self):
+    workbook_model = WorkbookModel()
+    workbook_model.load_file(funds, jobs=1)
+    incremental, full = Evaluator(workbook_model), Evaluator(workbook_model)
+
+    inputs = sorted(cell for cell in set(
+      (r.sheet_name, r.top, r.left) for ranges in incremental.ranges.values() for r, _ in ranges
+    ) if cell not in incremental.formulas and type(incremental.value(*cell)) in (int, float))
+    for k, cell in enumerate(inputs[:50]):
+      self.assertTrue(incremental.set_value(*(cell + (k + 0.5,))))
+      full.set_value(*(cell + (k + 0.5,)))
+
+    changed = incremental.recalculate()
+    self.assertTrue(changed)
+    self.assertLess(len(changed), len(incremental.order))
+    self.assertEqual([], incremental.recalculate())
+
+    full.recalculate_all()
+    self.assertEqual(full.values, incremental.values)
+
+  def test_functions(self):
+    evaluator = Evaluator(workbook(
+      A=[
+        ['=B1*2', '=SUM(C1:E2)', 1, 2, 3],
+        ['=AVERAGE(C1:E1)', '=IF(A1>B1,"a"&C1,-C2%)', 4, 'x', True],
+        ['=INDEX(C1:E2,2,1)', '=MATCH(3,C1:E1,0)', '=1/0', '=IFERROR(C3,B!A1)', '=MATCH(2.5,C1:E1)'],
+      ],
+      B=[['=A!C1+1']]
+    ))
+    evaluator.recalculate()
+    self.assertEqual(
+      [20, 10, 2, 'a1', 4, 3, Error('#DIV/0!'), 2, 2],
+      [evaluator.value('A', 0, 0), evaluator.value('A', 0, 1), evaluator.value('A', 1, 0),
+       evaluator.value('A', 1, 1), evaluator.value('A', 2, 0), evaluator.value('A', 2, 1),
+       evaluator.value('A', 2, 2), evaluator.value('A', 2, 3), evaluator.value('A', 2, 4)]
+    )
+    self.assertIs(Error, type(evaluator.value('A', 2, 2)))
+
+  def test_round(self):
+    evaluator = Evaluator(workbook(A=[
+      ['=ROUND(1E+308,2)', '=ROUND(5,-400)', '=ROUND(-2.5,0)', '=ROUND(1234.5678,-2)', '=ROUND(1)', '=ROUND(1,2,3)']
+    ]))
+    evaluator.recalculate()
+    self.assertEqual([1e308, 0, -3, 1200], [evaluator.value('A', 0, k) for k in range(4)])
+    self.assertEqual([('A', 0, 4), ('A', 0, 5)], evaluator.unsupported)
+
+  def test_numbers(self):
+    evaluator = Evaluator(workbook(A=[
+      ['=1E+300*1E+300', '=B!A1+1', '=B!B1+1', '=B!C1*1', '=" 2.5e1 "+1', '=SUM(1E+308,1E+308)'],
+    ], B=[['nan', 'inf', '1_0']]))
+    evaluator.recalculate()
+    self.assertEqual(
+      [Error('#NUM!'), Error('#VALUE!'), Error('#VALUE!'), Error('#VALUE!'), 26, Error('#NUM!')],
+      [evaluator.value('A', 0, k) for k in range(6)]
+    )
+
+  def test_dates(self):
+    evaluator = Evaluator(workbook(A=[
+      [datetime.datetime(2020, 1, 1, 12), datetime.date(2020, 1, 2), '=A1>0', '=B1+1', '=MATCH(C2,A1:B1,0)', '=SUM(A1:B1)'],
+      ['=A1<B1', '=COUNT(A1:B1)', 43832],
+    ]))
+    evaluator.recalculate()
+    self.assertEqual(
+      [True, 43833, 2, 87663.5, True, 2],
+      [evaluator.value('A', 0, 2), evaluator.value('A', 0, 3), evaluator.value('A', 0, 4),
+       evaluator.value('A', 0, 5), evaluator.value('A', 1, 0), evaluator.value('A', 1, 1)]
+    )
+
+  def test_negation(self):
+    evaluator = Evaluator(workbook(A=[['=--C1', '=1+--C1', 2, '=-2^2', '=SUM(--(C1>0),1)']]))
+    self.assertEqual([], evaluator.unsupported)
+    evaluator.recalculate()
+    self.assertEqual([2, 3, 4, 2], [evaluator.value('A', 0, k) for k in (0, 1, 3, 4)])
+
+    # left with two values, or none for the operator
+    self.assertIsNone(evaluator.compile_rpn('A', list(shunting_yard('=1+2'))[:2]))
+    self.assertIsNone(evaluator.compile_rpn('A', list(shunting_yard('=1+2'))[1:]))
+
+  def test_sheet_references(self):
+    evaluator = Evaluator(workbook(**{
+      'A': [["='B C'!A1+1", "='[1]B C'!A1", '=[1]A!A1', "='it''s'!A1", '=Q!A1']],
+      'B C': [[1]],
+      "it's": [[2]],
+    }))
+    self.assertEqual([('A', 0, 1), ('A', 0, 2)], evaluator.unsupported)
+    evaluator.recalculate()
+    self.assertEqual([2, 2, Error('#REF!')], [evaluator.value('A', 0, k) for k in (0, 3, 4)])
+
+  def test_graph(self):
+    evaluator = Evaluator(workbook(A=[['=B1+1', '=C1+1', 1, '=E1', '=D1', '=FOO(1)', '=IF(B1,,"x")', '=SUM(1,)']]))
+    self.assertEqual([('A', 0, 1), ('A', 0, 0)], evaluator.order)
+    self.assertEqual([('A', 0, 3), ('A', 0, 4)], evaluator.circular)
+    self.assertEqual([('A', 0, 5), ('A', 0, 6), ('A', 0, 7)], evaluator.unsupported)
+    evaluator.recalculate()
+    self.assertEqual(3, evaluator.value('A', 0, 0))
+    self.assertRaises(ValueError, evaluator.set_value, 'A', 0, 1, 5)
+    self.assertRaises(ValueError, evaluator.set_value, 'A', 0, 5, 5)
+    self.assertRaises(IndexError, evaluator.set_value, 'A', 1, 0, 5)
+    self.assertTrue(evaluator.set_value('A', 0, 2, 5))
+    self.assertEqual([('A', 0, 1), ('A', 0, 0)], evaluator.recalculate())
+    self.assertEqual(7, evaluator.value('A', 0, 0))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,1374 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import re
+import csv
+import collections
+import itertools
+import argparse
+import concurrent.futures
+import multiprocessing
+import hashlib
+import pickle
+import zlib
+import json
+import math
+import struct
+
+from array import array
+
+import openpyxl
+from openpyxl.cell.read_only import EMPTY_CELL
+from tokenizer import shunting_yard
+import xls_biff
+
+try:
+  import h5py
+  import numpy
+except ImportError:
+  h5py = numpy = None
+
+import warnings
+warnings.filterwarnings("ignore")
+
+
+if sys.version_info < (3,):
+  def is_string(s):
+    return type(s) in [str, unicode]
+else:
+  def is_string(s):
+    return type(s) == str
+
+
+def slugify(value):
+  import unicodedata
+  value = unicodedata.normalize('NFKD', cell_text(value))
+  value = re.sub('[^\w\s-]', '', value).strip().lower()
+  return re.sub('[-\s]+', '-', value)
+
+
+def cell_text(value):
+  """Return the displayed text of a cell value"""
+  if value is None:
+    return ''
+  if is_string(value):
+    return value.strip()
+  return str(value)
+
+
+class ExcelLoader:
+  """Workbook reader. Each sheet is parsed once, formula cells carry both
+  their formula (cell.formula) and their cached result (cell.value).
+
+  In read_only mode sheets are streamed from the archive row by row and no
+  cells are kept, otherwise the whole workbook is loaded into memory.
+  Legacy BIFF8 .xls workbooks are always streamed by xls_biff."""
+  def __init__(self, filename, read_only=False):
+    if xls_biff.is_compound_file(filename):
+      self.read_only = True
+      self.workbook_normal = xls_biff.BiffWorkbook(filename)
+      return
+
+    self.read_only = read_only
+    self.workbook_normal = openpyxl.load_workbook(filename, data_only=False, read_only=read_only)
+
+  def iter_rows(self, sheet_name):
+    sheet = self.workbook_normal[sheet_name]
+    if not self.read_only:
+      return sheet.iter_rows()
+    return self.stream_rows(sheet)
+
+  def stream_rows(self, sheet):
+    """Return generator for the rows of read-only sheet, starting at A1 like
+    the full reader's. Rows without cells are held back until a row with
+    cells follows, so trailing ones are dropped; an empty sheet still has
+    its single cell A1"""
+    empty_rows = 0
+    yielded = False
+    for row in sheet.get_squared_range(1, 1, None, None):
+      if not row:
+        empty_rows += 1
+        continue
+      for _ in range(empty_rows):
+        yield ()
+      empty_rows = 0
+      yielded = True
+      yield row
+
+    if not yielded:
+      yield (EMPTY_CELL,)
+
+  def iter_values(self, sheet_name):
+    """Return generator for rows of tuples (value, formula) of the cells,
+    value being the cached result of formula, formula None for constants"""
+    for row in self.iter_rows(sheet_name):
+      yield [(cell.value, cell.formula or None) for cell in row]
+
+  def iter_icells(self, sheet_name):
+    """Return generator for all cells with offsets prepended"""
+    for i, row in enumerate(self.iter_rows(sheet_name)):
+      for j, cell in enumerate(row):
+        if not cell:
+          continue
+        yield (i, j, cell)
+
+  def sheet_names(self):
+    return self.workbook_normal.get_sheet_names()
+
+  def close(self):
+    """Close the archive a read-only workbook streams its sheets from"""
+    if isinstance(self.workbook_normal, xls_biff.BiffWorkbook):
+      self.workbook_normal.close()
+      return
+    archive = getattr(self.workbook_normal, '_archive', None)
+    if archive is not None:
+      archive.close()
+
+
+class ExcelFormula:
+  # string literals and quoted names are matched as a whole and kept, so
+  # only the cell references outside of them get the groups filled in
+  A1_REFERENCE = re.compile(
+    r'''"(?:[^"]|"")*"|'(?:[^']|'')*'|'''
+    r'''(?<![\w.$])(\$?)([A-Z]{1,3})(\$?)([1-9][0-9]*)(?![\w(!.])'''
+  )
+  RANGE_REFERENCE = re.compile(r'(([^!]+)\!)?([A-Z]+[0-9]+)(:[A-Z]+[0-9]+)?')
+  LINE_REFERENCE = re.compile(r'(([^!]+)\!)?([A-Z]+:[A-Z]+|[0-9]+:[0-9]+)()$')
+
+  # one token of a formula as split by tokenizer.ExcelParser: a string
+  # literal, an operand (possibly starting with a quoted name) or any other
+  # single character. Brackets, arrays, errors, ';' and numbers in scientific
+  # notation need the state machine of the real parser
+  OPERAND_TOKEN = re.compile(
+    r'''"(?:[^"]|"")*"'''
+    r'''|'(?P<quoted>(?:[^']|'')*)'(?P<rest>[^-+*/^&=<>%,;(){}"'\[\]# ]*)'''
+    r'''|(?P<plain>[^-+*/^&=<>%,;(){}"'\[\]# ]+)'''
+    r'''|(?P<other>.)''', re.S
+  )
+  NEEDS_PARSER = re.compile(r'[\[\]{}#;]|[0-9][eE][-+]')
+  CELL = re.compile(r'[A-Z]{1,3}[1-9][0-9]*$')
+
+  reference_cache = collections.OrderedDict()
+  reference_cache_size = 10000
+
+  @staticmethod
+  def all_cell_coordinates(formula):
+    rpn = shunting_yard(formula)
+    for node in rpn:
+      if node.token.ttype == 'operand' and node.token.tsubtype == 'range':
+        yield node.token.tvalue
+
+  @staticmethod
+  def relative_r1c1(formula, row, column):
+    """Return formula with its cell references in R1C1 notation relative to
+    cell (row, column). Formulas copied along a row or column share the result"""
+    def r1c1(m):
+      if m.group(2) is None:
+        return m.group(0)
+      r = int(m.group(4)) - 1
+      c = ExcelFormula.column_index(m.group(2))
+      return '{0}{1}'.format(
+        m.group(3) and 'R{0}'.format(r+1) or 'R[{0}]'.format(r-row),
+        m.group(1) and 'C{0}'.format(c+1) or 'C[{0}]'.format(c-column)
+      )
+    return ExcelFormula.A1_REFERENCE.sub(r1c1, formula)
+
+  @staticmethod
+  def cell_references(formula, row, column):
+    """Return list of the references in formula of cell (row, column).
+
+    Items are tuples (sheet_name or None, (top, left, bottom, right)) of zero
+    based offsets, open ends of whole columns or rows being None. An
+    unresolvable reference ends the list with None.
+    Formulas are parsed once per distinct relative R1C1 form and the cached
+    references are moved to the requesting cell."""
+    shape = ExcelFormula.relative_r1c1(formula, row, column)
+    cache = ExcelFormula.reference_cache
+
+    refs = cache.get(shape)
+    if refs is None:
+      refs = list(ExcelFormula.relative_references(formula, row, column))
+      # absolute cell ranges of operands relative_r1c1 rewrote anyway (like
+      # A1:B2:C3) are not determined by the shape, such formulas aren't cached
+      if all(ref is None or ref[2] or None in ref[1] for ref in refs):
+        cache[shape] = refs
+        if len(cache) > ExcelFormula.reference_cache_size:
+          cache.popitem(last=False)
+    else:
+      cache.move_to_end(shape)
+
+    ret = []
+    for ref in refs:
+      if ref is None:
+        ret.append(None)
+        break
+      sheet_name, (top, left, bottom, right), relative = ref
+      if relative:
+        ret.append((sheet_name, (top+row, left+column, bottom+row, right+column)))
+      else:
+        ret.append((sheet_name, (top, left, bottom, right)))
+    return ret
+
+  @staticmethod
+  def range_operands(formula):
+    """Return list of the range operands of formula, as all_cell_coordinates
+    but scanning the formula once without building the RPN when possible"""
+    if formula.startswith('='):
+      formula = formula[1:]
+    formula = formula.lstrip(' ')
+    if formula.startswith('='):
+      formula = formula[1:]
+
+    if ExcelFormula.NEEDS_PARSER.search(formula):
+      return list(ExcelFormula.all_cell_coordinates(formula))
+
+    operands = []
+    for m in ExcelFormula.OPERAND_TOKEN.finditer(formula):
+      if m.group('other') is not None:
+        if m.group('other') in '"\'':
+          # unterminated string or name
+          return list(ExcelFormula.all_cell_coordinates(formula))
+        continue
+
+      if m.group('quoted') is not None:
+        operand = m.group('quoted').replace("''", "'") + m.group('rest')
+      elif m.group('plain') is not None:
+        operand = m.group('plain')
+      else:
+        continue
+
+      if not operand:
+        continue
+
+      following = formula[m.end():m.end()+1]
+      if following in ['"', "'"]:
+        return list(ExcelFormula.all_cell_coordinates(formula))
+      if following == '(' or operand in ['TRUE', 'FALSE']:
+        continue
+
+      try:
+        float(operand)
+      except ValueError:
+        operands.append(operand)
+
+    return operands
+
+  @staticmethod
+  def references(formula):
+    """Return generator for tuples (sheet_name or None, range, exact) of the
+    range operands of formula, exact being False if trailing characters of
+    the operand were ignored. Ranges are cell ranges or whole columns (A:B)
+    or rows (1:2). An operand which is no reference yields None and ends the
+    generator"""
+    for operand in ExcelFormula.range_operands(formula):
+      m = ExcelFormula.RANGE_REFERENCE.match(operand) or \
+          ExcelFormula.LINE_REFERENCE.match(operand)
+      if not m:
+        yield None
+        return
+      yield (m.group(2), m.group(3) + (m.group(4) or ''), m.end() == len(operand))
+
+  @staticmethod
+  def relative_references(formula, row, column):
+    """Return generator for tuples (sheet_name, range, relative) of formula,
+    range being relative to cell (row, column) if relative is True"""
+    for ref in ExcelFormula.references(formula):
+      if ref is None:
+        yield None
+        return
+
+      sheet_name, cell_range, exact = ref
+      a, _, b = cell_range.partition(':')
+      b = b or a
+
+      # whole columns and rows stay where they are, open ends are None
+      if a.isalpha():
+        yield (sheet_name, (None, ExcelFormula.column_index(a), None, ExcelFormula.column_index(b)), False)
+        continue
+      if a.isdigit():
+        yield (sheet_name, (int(a)-1, None, int(b)-1, None), False)
+        continue
+
+      top, left = ExcelFormula.offsets_from_coordinates(a)
+      bottom, right = ExcelFormula.offsets_from_coordinates(b)
+
+      # only references relative_r1c1 rewrote may be moved with the formula
+      if exact and ExcelFormula.CELL.match(a) and ExcelFormula.CELL.match(b):
+        yield (sheet_name, (top-row, left-column, bottom-row, right-column), True)
+      else:
+        yield (sheet_name, (top, left, bottom, right), False)
+
+  @staticmethod
+  def column_index(letters):
+    """Return zero based index of column letters"""
+    index = 0
+    for letter in letters:
+      index = index*26 + ord(letter) - 64
+    return index - 1
+
+  @staticmethod
+  def expand_cell_range(cell_range):
+    """Return generator for offsets (tuples) of expanded cell range"""
+    m = re.match(r'([A-Z]+[0-9]+):([A-Z]+[0-9]+)', cell_range)
+    a = ExcelFormula.offsets_from_coordinates(m.group(1))
+    b = ExcelFormula.offsets_from_coordinates(m.group(2))
+
+    for i in range(a[0], b[0]+1):
+      for j in range(a[1], b[1]+1):
+        yield (i,j)
+
+  @staticmethod
+  def offsets_from_coordinates(coordinates):
+    xy = openpyxl.utils.coordinate_from_string(coordinates)
+    col = openpyxl.utils.column_index_from_string(xy[0])
+    row = xy[1]
+    return (row-1,col-1)
+
+
+class CellCategory:
+  Empty = 0
+  Label = 1
+  Input = 2
+  Output = 3
+  Intermediate = 4
+  Ignored = 5
+
+  Any = 6
+
+  @classmethod
+  def desc(self, category):
+    return {
+      self.Empty: 'Empty',
+      self.Label: 'Label',
+      self.Input: 'Input',
+      self.Output: 'Output',
+      self.Intermediate: 'Intermediate',
+      self.Ignored: 'Ignored'
+    }[category]
+
+  @classmethod
+  def categories(self):
+    return [
+      self.Empty,
+      self.Label,
+      self.Input,
+      self.Output,
+      self.Intermediate,
+      self.Ignored
+    ]
+
+
+class Direction:
+  Left = 0
+  Right = 1
+  Top = 2
+  Bottom = 3
+
+
+class Block:
+  def __init__(self, model, top_left=(0,0), bottom_right=(0,0), type_=CellCategory.Label):
+    self.top_left = top_left
+    self.bottom_right = bottom_right
+    self.type_ = type_
+    self.model = model
+
+    #print('{0}: {1}'.format(self.top_left, self.get_data(*self.top_left)))
+
+  def get_data(self, row, column):
+    return self.model.value(row + self.top_left[0], column + self.top_left[1])
+
+  def dimensions(self):
+    (ax, ay), (bx, by) = self.top_left, self.bottom_right
+    return (bx-ax+1, by-ay+1)
+
+  def row(self):
+    return self.top_left[0]
+
+  def column(self):
+    return self.top_left[1]
+
+  def row_count(self):
+    return self.dimensions()[0]
+
+  def column_count(self):
+    return self.dimensions()[1]
+
+
+# nearest blocks to the left and top of a block of any type, the label and
+# index blocks of a data block and its title, a single label cell at the top
+# or else at the left
+Neighbours = collections.namedtuple('Neighbours', ['left', 'top', 'label', 'index', 'title'])
+
+
+class Blocks:
+  """Ordered collection of blocks.
+
+  Blocks are additionally indexed by type in square buckets of bucket_size
+  cells keyed by their top left corner, which lets next_block search outwards
+  ring by ring instead of measuring every block.
+
+  The neighbours of all blocks are looked up once after the blocks changed
+  and kept in an adjacency graph, see graph()."""
+  bucket_size = 16
+
+  def __init__(self):
+    self.blocks = []
+    self.buckets = {}
+    self.extent = None
+    self.adjacency = None
+
+  def clear(self):
+    del self.blocks[:]
+    self.buckets.clear()
+    self.extent = None
+    self.adjacency = None
+
+  def add_block(self, block):
+    self.adjacency = None
+    key = self.bucket(block.row(), block.column())
+    self.buckets.setdefault(block.type_, {}).setdefault(key, []).append((len(self.blocks), block))
+    self.blocks.append(block)
+
+    if self.extent is None:
+      self.extent = [key[0], key[0], key[1], key[1]]
+    else:
+      self.extent = [
+        min(self.extent[0], key[0]), max(self.extent[1], key[0]),
+        min(self.extent[2], key[1]), max(self.extent[3], key[1])
+      ]
+
+  def bucket(self, row, column):
+    return (row // self.bucket_size, column // self.bucket_size)
+
+  def replace(self, removed, added):
+    """Replace blocks, keeping all blocks ordered by their top left corners"""
+    removed = set(removed)
+    blocks = [b for b in self.blocks if b not in removed] + list(added)
+    blocks.sort(key=lambda b: b.top_left)
+
+    self.clear()
+    [self.add_block(b) for b in blocks]
+
+  def indices(self):
+    return self.blocks
+
+  def data_blocks(self):
+    for  block in self.blocks:
+      if block.type_ in [CellCategory.Input, CellCategory.Output, CellCategory.Intermediate]:
+        yield block
+
+  @staticmethod
+  def ring(row, column, distance):
+    """Return generator for bucket keys at Chebyshev distance around (row, column)"""
+    if distance == 0:
+      yield (row, column)
+      return
+    for c in range(column-distance, column+distance+1):
+      yield (row-distance, c)
+      yield (row+distance, c)
+    for r in range(row-distance+1, row+distance):
+      yield (r, column-distance)
+      yield (r, column+distance)
+
+  def next_block(self, block, direction, position=(-1,-1), dimensions=(0,0), type_=CellCategory.Any):
+    """Return the block whose top left corner is nearest to the one of block,
+    lying strictly in direction and matching position, dimensions and type_
+    (-1, 0 and CellCategory.Any match anything). Ties go to the block added first"""
+    if type_ == CellCategory.Any:
+      indices = list(self.buckets.values())
+    elif type_ in self.buckets:
+      indices = [self.buckets[type_]]
+    else:
+      return None
+
+    if self.extent is None:
+      return None
+
+    row, column = block.row(), block.column()
+    br, bc = self.bucket(row, column)
+    max_distance = max(
+      abs(br - self.extent[0]), abs(br - self.extent[1]),
+      abs(bc - self.extent[2]), abs(bc - self.extent[3])
+    )
+
+    best = None
+    for distance in range(max_distance+1):
+      if best and distance > 0:
+        nearest = (distance-1)*self.bucket_size + 1
+        if nearest*nearest > best[0]:
+          break
+
+      for r, c in self.ring(br, bc, distance):
+        if (direction == Direction.Top and r > br) or \
+          (direction == Direction.Bottom and r < br) or \
+          (direction == Direction.Left and c > bc) or \
+          (direction == Direction.Right and c < bc):
+          continue
+
+        for index in indices:
+          for order, bl in index.get((r, c), ()):
+            if (dimensions[0] != 0 and dimensions[0] != bl.row_count()) or \
+              (dimensions[1] != 0 and dimensions[1] != bl.column_count()):
+              continue
+
+            if (position[0] != -1 and position[0] != bl.row()) or \
+              (position[1] != -1 and position[1] != bl.column()):
+              continue
+
+            if (direction == Direction.Top and row <= bl.row()) or \
+              (direction == Direction.Bottom and row >= bl.row()) or \
+              (direction == Direction.Left and column <= bl.column()) or \
+              (direction == Direction.Right and column >= bl.column()):
+              continue
+
+            distance2 = pow(row-bl.row(), 2) + pow(column-bl.column(), 2)
+            if best is None or (distance2, order) < best[:2]:
+              best = (distance2, order, bl)
+
+    if best:
+      return best[2]
+    else:
+      return None
+
+
+  def graph(self):
+    """Return dict block -> Neighbours of all blocks, built on first use
+    after the blocks changed"""
+    if self.adjacency is None:
+      data_types = (CellCategory.Input, CellCategory.Output, CellCategory.Intermediate)
+      adjacency = {}
+      for block in self.blocks:
+        left = self.next_block(block, Direction.Left)
+        top = self.next_block(block, Direction.Top)
+        label = index = None
+        if block.type_ in data_types:
+          label = self.next_block(
+            block, Direction.Left, (-1, -1), (block.row_count(), 1), CellCategory.Label
+          )
+          index = self.next_block(
+            block, Direction.Top, (-1, -1), (0, block.column_count()), CellCategory.Label
+          )
+
+        title = None
+        for neighbour in (top, left):
+          if neighbour and neighbour.dimensions() == (1,1) and neighbour.type_ == CellCategory.Label:
+            title = neighbour
+            break
+
+        adjacency[block] = Neighbours(left, top, label, index, title)
+      self.adjacency = adjacency
+
+    return self.adjacency
+
+  def neighbours(self, block):
+    """Return Neighbours of block"""
+    return self.graph()[block]
+
+  def tables(self):
+    """Return generator for an ExportTable per data block having label and
+    index blocks, its values sliced row by row out of the grid"""
+    graph = self.graph()
+    for block in self.data_blocks():
+      _, _, label_block, index_block, title_block = graph[block]
+      if not (label_block and index_block):
+        continue
+
+      title = title_block.get_data(0,0) if title_block else None
+
+      grid = block.model
+      (top, left), (bottom, right) = block.top_left, block.bottom_right
+      (_, index_left), (index_row, index_right) = index_block.top_left, index_block.bottom_right
+
+      yield ExportTable(
+        title,
+        grid.block_values(label_block),
+        grid.values[grid.offset(index_row, index_left):grid.offset(index_row, index_right)+1],
+        [grid.values[grid.offset(i, left):grid.offset(i, right)+1] for i in range(top, bottom+1)],
+        block
+      )
+
+  def export(self, directory, format='csv', prefix='', jobs=None):
+    """Write every data block with label and index blocks to directory as
+    CSV or columnar binary (format 'xcol'). Return the list of written paths"""
+    return export_tables(list(self.tables()), directory, format, prefix, jobs)
+
+
+# an exported data block: its title (or None), the labels of its rows, the
+# index of its columns, a list of the values of each row
+# and the data block itself
+ExportTable = collections.namedtuple('ExportTable', ['title', 'labels', 'index', 'rows', 'block'])
+
+COLUMNAR_MAGIC = b'XCOL'
+
+
+def write_csv(path, table):
+  """Write table to path as CSV, a line per column of the data block"""
+  with open(path, 'w', newline='', buffering=1 << 16) as f:
+    writer = csv.writer(f)
+    writer.writerow(['Index'] + table.labels)
+    writer.writerows(zip(table.index, *table.rows))
+
+
+def write_columnar(path, table):
+  """Write table to path in the columnar binary format: magic, header size
+  (uint32), JSON header and the data, a little endian float64 column for
+  each numeric row of the data block and a JSON list for the others"""
+  header = {
+    'title': None if table.title is None else cell_text(table.title),
+    'index': [cell_text(value) for value in table.index],
+    'columns': []
+  }
+
+  offset = 0
+  data = []
+  for label, values in zip(table.labels, table.rows):
+    if all(value is None or type(value) in (int, float) for value in values):
+      column = array('d', [float('nan') if value is None else value for value in values])
+      if sys.byteorder == 'big':
+        column.byteswap()
+      type_, column = 'f8', column.tobytes()
+    else:
+      type_ = 'json'
+      column = json.dumps([value if value is None else cell_text(value) for value in values]).encode('utf-8')
+
+    header['columns'].append({'name': cell_text(label), 'type': type_, 'offset': offset, 'size': len(column)})
+    data.append(column)
+    offset += len(column)
+
+  header = json.dumps(header).encode('utf-8')
+  with open(path, 'wb') as f:
+    f.write(COLUMNAR_MAGIC + struct.pack('<I', len(header)) + header)
+    f.write(b''.join(data))
+
+
+def read_columnar(path):
+  """Return tuple (title, index, list of tuples (name, values)) of a file
+  written by write_columnar, the columns in the order written (names may
+  repeat or be empty), missing numbers being None"""
+  with open(path, 'rb') as f:
+    data = f.read()
+  if data[:4] != COLUMNAR_MAGIC:
+    raise ValueError('{0} is no columnar export'.format(path))
+
+  size = struct.unpack_from('<I', data, 4)[0]
+  header = json.loads(data[8:8+size].decode('utf-8'))
+  start = 8 + size
+
+  columns = []
+  for column in header['columns']:
+    chunk = data[start+column['offset']:start+column['offset']+column['size']]
+    if column['type'] == 'f8':
+      values = array('d')
+      values.frombytes(chunk)
+      if sys.byteorder == 'big':
+        values.byteswap()
+      columns.append((column['name'], [None if math.isnan(value) else value for value in values]))
+    else:
+      columns.append((column['name'], json.loads(chunk.decode('utf-8'))))
+
+  return header['title'], header['index'], columns
+
+
+EXPORT_FORMATS = {
+  'csv': (write_csv, '.csv'),
+  'xcol': (write_columnar, '.xcol'),
+}
+
+
+def export_names(tables, prefix=''):
+  """Return list of unique file names (without extension) for tables, the
+  slug of their title or 'block', numbered from -2 on if taken before"""
+  names, used = [], set()
+  for table in tables:
+    base = prefix + ((slugify(table.title) if table.title is not None else '') or 'block')
+    name, number = base, 1
+    while name in used:
+      number += 1
+      name = '{0}-{1}'.format(base, number)
+    used.add(name)
+    names.append(name)
+  return names
+
+
+def export_tables(tables, directory, format='csv', prefix='', jobs=None):
+  """Write tables to directory by a pool of jobs threads (one per core if
+  None), named by export_names. Return the list of written paths"""
+  write, extension = EXPORT_FORMATS[format]
+  paths = [os.path.join(directory, name + extension) for name in export_names(tables, prefix)]
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+    for future in [executor.submit(write, path, table) for path, table in zip(paths, tables)]:
+      future.result()
+
+  return paths
+
+
+def export_workbook(workbook_model, directory, format='csv', prefix='', jobs=None):
+  """Write the data blocks of all sheets of workbook_model to directory,
+  names being unique across the sheets. Return the list of written paths"""
+  tables = [table for sheet_name in workbook_model.sheet_names()
+    for table in workbook_model.sheet_grids[sheet_name].blocks.tables()]
+  return export_tables(tables, directory, format, prefix, jobs)
+
+
+def hdf5_data(table):
+  """Return tuple (rows, numeric) of the data of table as stored by
+  write_hdf5, rows of floats (nan for empty cells) if all values are
+  numeric, rows of texts otherwise"""
+  if all(value is None or type(value) in (int, float) for values in table.rows for value in values):
+    return [[float('nan') if value is None else float(value) for value in values] for values in table.rows], True
+  return [[cell_text(value) for value in values] for values in table.rows], False
+
+
+def write_hdf5(path, workbook_model):
+  """Write the data blocks of all sheets of workbook_model to the HDF5 file
+  path, each as chunked dataset /<sheet>/<top left cell>/data (compressed
+  if numeric) with its labels and index attached as dimension scales.
+  Return the list of written dataset names"""
+  if h5py is None:
+    raise RuntimeError('HDF5 export needs h5py and numpy')
+
+  text = h5py.string_dtype()
+
+  written = []
+  with h5py.File(path, 'w') as f:
+    for sheet_name in workbook_model.sheet_names():
+      tables = list(workbook_model.sheet_grids[sheet_name].blocks.tables())
+      if not tables:
+        continue
+
+      sheet = f.create_group(sheet_name)
+      for table in tables:
+        row, column = table.block.top_left
+        group = sheet.create_group(openpyxl.utils.get_column_letter(column+1) + str(row+1))
+        if table.title is not None:
+          group.attrs['title'] = cell_text(table.title)
+
+        rows, numeric = hdf5_data(table)
+        if numeric:
+          data = group.create_dataset('data', data=numpy.array(rows, dtype='f8'), dtype='f8',
+            chunks=True, compression='gzip', shuffle=True)
+        else:
+          # filters would only compress the references to the strings
+          data = group.create_dataset('data', data=rows, dtype=text, chunks=True)
+
+        for dimension, name, scale in ((0, 'labels', table.labels), (1, 'index', table.index)):
+          scale = group.create_dataset(name, data=[cell_text(value) for value in scale], dtype=text)
+          scale.make_scale(name)
+          data.dims[dimension].attach_scale(scale)
+
+        written.append(data.name)
+
+  return written
+
+
+# category transitions of referenced cells as byte translation table
+REFERENCED = bytes(
+  {CellCategory.Output: CellCategory.Intermediate, CellCategory.Label: CellCategory.Input}.get(i, i)
+  for i in range(256)
+)
+
+
+class SheetGrid:
+  """Cell data of a single sheet, independent of Qt.
+
+  Values, formulas, categories and user-set categories are kept in flat
+  row-major parallel arrays, cell (row, column) lives at offset
+  row*column_count + column. A set category of -1 means 'not set'.
+  """
+  def __init__(self, sheet_name, excel_loader=None):
+    self.sheet_name = sheet_name
+
+    self.row_count = 0
+    self.column_count = 0
+
+    self.values = []
+    self.formulas = []
+    self.categories = array('b')
+    self.set_categories = array('b')
+
+    self.blocks = Blocks()
+
+    if excel_loader:
+      self.load(excel_loader)
+
+  def load(self, excel_loader):
+    # rows are appended as they are streamed and padded to the widest row
+    # once it is known
+    widths = array('l')
+    for row in excel_loader.iter_values(self.sheet_name):
+      widths.append(len(row))
+      for value, formula in row:
+        self.values.append(value)
+        self.formulas.append(formula)
+
+    self.row_count = len(widths)
+    self.column_count = max(widths or [0])
+
+    if len(self.values) != self.row_count*self.column_count:
+      values, formulas = self.values, self.formulas
+      self.values, self.formulas = [], []
+      k = 0
+      for width in widths:
+        padding = [None] * (self.column_count - width)
+        self.values += values[k:k+width] + padding
+        self.formulas += formulas[k:k+width] + padding
+        k += width
+
+    self.categories = array('b', [
+      cell_text(value) and CellCategory.Label or CellCategory.Empty
+      for value in self.values
+    ])
+    self.set_categories = array('b', [-1]) * len(self.values)
+
+  def state(self):
+    """Return loaded, categorised and scanned grid as tuple of plain values,
+    user-set categories are left out"""
+    return (
+      self.sheet_name, self.row_count, self.column_count, self.values, self.formulas,
+      self.categories.tobytes(),
+      [(b.top_left, b.bottom_right, b.type_) for b in self.blocks.indices()]
+    )
+
+  @classmethod
+  def from_state(cls, state):
+    """Return grid restored from state()"""
+    sheet_name, row_count, column_count, values, formulas, categories, blocks = state
+
+    grid = cls(sheet_name)
+    grid.row_count, grid.column_count = row_count, column_count
+    grid.values, grid.formulas = values, formulas
+    grid.categories = array('b', categories)
+    grid.set_categories = array('b', [-1]) * len(values)
+    grid.blocks.replace([], [Block(grid, *block) for block in blocks])
+    return grid
+
+  def offset(self, row, column):
+    return row*self.column_count + column
+
+  def contains(self, row, column):
+    return 0 <= row < self.row_count and 0 <= column < self.column_count
+
+  def value(self, row, column):
+    return self.values[self.offset(row, column)]
+
+  def block_values(self, block):
+    """Return list of the values of block in row-major order"""
+    (top, left), (bottom, right) = block.top_left, block.bottom_right
+    values = []
+    for i in range(top, bottom+1):
+      values += self.values[self.offset(i, left):self.offset(i, right)+1]
+    return values
+
+  def formula(self, row, column):
+    return self.formulas[self.offset(row, column)]
+
+  def text(self, row, column):
+    return cell_text(self.value(row, column))
+
+  def get_category(self, row, column):
+    k = self.offset(row, column)
+    ret = self.set_categories[k]
+    if ret == -1:
+      ret = self.categories[k]
+    return ret
+
+  def set_category(self, row, column, category):
+    self.set_categories[self.offset(row, column)] = category
+
+  def insert_row(self, row):
+    """Insert an empty row before row and rescan the blocks, which all may
+    have moved. Return update()"""
+    k = self.offset(row, 0)
+    n = self.column_count
+    self.values[k:k] = [None] * n
+    self.formulas[k:k] = [None] * n
+    self.categories[k:k] = array('b', [CellCategory.Empty]) * n
+    self.set_categories[k:k] = array('b', [-1]) * n
+    self.row_count += 1
+    return self.update()
+
+  def remove_row(self, row):
+    """Remove row and rescan the blocks, see insert_row"""
+    k = self.offset(row, 0)
+    n = self.column_count
+    del self.values[k:k+n]
+    del self.formulas[k:k+n]
+    del self.categories[k:k+n]
+    del self.set_categories[k:k+n]
+    self.row_count -= 1
+    return self.update()
+
+  def calculate_references(self):
+    """Return dict (sheet_name -> list of referenced ranges (top, left, bottom, right))"""
+    refs = {}
+    for k, text in enumerate(self.formulas):
+      if not text:
+        continue
+
+      if is_string(text) and text.startswith('='):
+        self.categories[k] = CellCategory.Output
+
+        row, column = divmod(k, self.column_count)
+
+        for ref in ExcelFormula.cell_references(text, row, column):
+          if ref is None:
+            # cell is error!
+            self.formulas[k] = '\''+text
+            self.values[k] = '\''+text
+            break
+
+          sheet_name = ref[0] or self.sheet_name
+
+          if not sheet_name in refs: refs[sheet_name] = []
+          refs[sheet_name].append(ref[1])
+
+    return refs
+
+  def disjoint_ranges(self, refs):
+    """Return list of disjoint ranges (top, left, bottom, right) covering the
+    union of the ranges refs, clipped to the sheet"""
+    clipped = []
+    for top, left, bottom, right in refs:
+      top = 0 if top is None else max(top, 0)
+      left = 0 if left is None else max(left, 0)
+      bottom = min(self.row_count-1 if bottom is None else bottom, self.row_count-1)
+      right = min(self.column_count-1 if right is None else right, self.column_count-1)
+      if top <= bottom and left <= right:
+        clipped.append((top, left, bottom, right))
+
+    # cut the sheet into bands of rows covered by the same ranges, merge the
+    # column intervals of each band and join adjacent bands of equal intervals
+    clipped = sorted(set(clipped))
+    edges = sorted(set([r[0] for r in clipped] + [r[2]+1 for r in clipped]))
+    ranges = []
+    open_ranges = {}
+    active = []
+    k = 0
+
+    for top in edges[:-1]:
+      while k < len(clipped) and clipped[k][0] == top:
+        active.append(clipped[k])
+        k += 1
+      active = [r for r in active if r[2] >= top]
+
+      intervals = sorted((r[1], r[3]) for r in active)
+      merged = []
+      for left, right in intervals:
+        if merged and left <= merged[-1][1]+1:
+          merged[-1][1] = max(merged[-1][1], right)
+        else:
+          merged.append([left, right])
+
+      band = {}
+      for left, right in merged:
+        previous = open_ranges.pop((left, right), None)
+        band[(left, right)] = top if previous is None else previous
+      for (left, right), start in open_ranges.items():
+        ranges.append((start, left, top-1, right))
+      open_ranges = band
+
+    if edges:
+      for (left, right), start in open_ranges.items():
+        ranges.append((start, left, edges[-1]-1, right))
+
+    return ranges
+
+  def apply_references(self, refs):
+    """Turn referenced outputs into intermediates and labels into inputs"""
+    for top, left, bottom, right in self.disjoint_ranges(refs):
+      for i in range(top, bottom+1):
+        a, b = self.offset(i, left), self.offset(i, right)+1
+        self.categories[a:b] = array('b', self.categories[a:b].tobytes().translate(REFERENCED))
+
+  def update(self, rows=None):
+    """Rescan blocks and return tuple (removed blocks, added blocks).
+
+    If rows (first, last) is given, only these rows changed their categories.
+    Then only they, their neighbour rows and the blocks vertically connected
+    to them are rescanned and the blocks are patched in place."""
+    if rows is None:
+      removed = list(self.blocks.indices())
+      added = self.scan_blocks()
+    else:
+      first, last = max(rows[0]-1, 0), min(rows[1]+1, self.row_count-1)
+      while True:
+        removed = [
+          b for b in self.blocks.indices()
+          if b.row() <= last and b.bottom_right[0] >= first
+        ]
+        window = (
+          min([first] + [b.row() for b in removed]),
+          max([last] + [b.bottom_right[0] for b in removed])
+        )
+        if window == (first, last):
+          break
+        first, last = window
+      added = self.scan_blocks(first, last)
+
+    self.blocks.replace(removed, added)
+    return (removed, added)
+
+  def reset_categories(self):
+    self.set_categories = array('b', [-1]) * len(self.values)
+    self.update()
+
+  def effective_categories(self, first_row=0, last_row=None):
+    """Return array of categories of rows first_row to last_row (default: all),
+    set categories taking precedence"""
+    if last_row is None:
+      last_row = self.row_count - 1
+    a, b = self.offset(first_row, 0), self.offset(last_row+1, 0)
+    return array('b', [
+      category if set_category == -1 else set_category
+      for category, set_category in zip(self.categories[a:b], self.set_categories[a:b])
+    ])
+
+  def scan_blocks(self, first_row=0, last_row=None):
+    """Return list of blocks of rows first_row to last_row (default: all) in
+    the order of their top left corners.
+
+    A block is a maximal vertical run of identical row sections, a row section
+    being a run of equal, non-empty categories within a row. Each row is
+    run-length encoded once and matched against the sections still open from
+    the row above, so the scan is linear in the number of cells."""
+    if last_row is None:
+      last_row = self.row_count - 1
+    categories = self.effective_categories(first_row, last_row)
+    n = self.column_count
+
+    blocks = []
+    open_blocks = {}
+
+    for i in range(first_row, last_row+1):
+      sections = {}
+      start = 0
+      k = (i-first_row) * n
+      for cat, run in itertools.groupby(categories[k:k+n]):
+        end = start + len(list(run)) - 1
+        if cat != CellCategory.Empty:
+          key = (start, end, cat)
+          block = open_blocks.get(key)
+          if block:
+            block.bottom_right = (i, end)
+          else:
+            block = Block(self, (i, start), (i, end), cat)
+            blocks.append(block)
+          sections[key] = block
+        start = end + 1
+      open_blocks = sections
+
+    return blocks
+
+
+class WorkbookCache:
+  """On-disk cache of loaded workbooks in directory, keyed by SHA-256 and
+  mtime of the file. Entries are zlib compressed pickles of the grid
+  states, the least recently used are removed beyond max_size bytes."""
+  # part of the entry names: bump with every change to what loading stores
+  # (readers, formula references, categories, blocks or the grid state),
+  # entries of other versions are never read and evicted first
+  version = 2
+
+  def __init__(self, directory=None, max_size=256*1024*1024):
+    if directory is None:
+      base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+      directory = os.path.join(base, 'xls_processor')
+    self.directory = directory
+    self.max_size = max_size
+    self.hashes = {}
+
+  def path(self, filename):
+    """Return path of the cache entry of filename"""
+    stat = os.stat(filename)
+
+    # hash every version of a file once per process
+    key = (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+    if key not in self.hashes:
+      sha = hashlib.sha256()
+      with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+          sha.update(chunk)
+      self.hashes[key] = sha.hexdigest()
+
+    name = '{0}-{1}.v{2}'.format(self.hashes[key], stat.st_mtime_ns, self.version)
+    return os.path.join(self.directory, name)
+
+  def get(self, filename):
+    """Return tuple (sheet names, dict sheet_name -> SheetGrid) of cached
+    workbook filename or None"""
+    path = self.path(filename)
+    try:
+      with open(path, 'rb') as f:
+        names, states = pickle.loads(zlib.decompress(f.read()))
+      os.utime(path)
+    except FileNotFoundError:
+      return None
+    except (OSError, zlib.error, pickle.UnpicklingError, EOFError, ValueError):
+      # damaged entry, load the file again
+      self.remove(path)
+      return None
+
+    return names, {state[0]: SheetGrid.from_state(state) for state in states}
+
+  def put(self, filename, names, grids):
+    """Store sheets names with their grids (dict sheet_name -> SheetGrid) as
+    cache entry of workbook filename. Failing to write is not an error."""
+    try:
+      os.makedirs(self.directory, exist_ok=True)
+      path = self.path(filename)
+      data = pickle.dumps((names, [grids[name].state() for name in names]), pickle.HIGHEST_PROTOCOL)
+
+      # entries appear complete or not at all for concurrent readers
+      temp = '{0}.{1}.tmp'.format(path, os.getpid())
+      with open(temp, 'wb') as f:
+        f.write(zlib.compress(data, 1))
+      os.replace(temp, path)
+    except OSError:
+      return
+
+    self.evict()
+
+  def evict(self):
+    """Remove least recently used entries until the cache fits max_size"""
+    entries = []
+    for name in os.listdir(self.directory):
+      if name.endswith('.tmp'):
+        continue
+      path = os.path.join(self.directory, name)
+      try:
+        stat = os.stat(path)
+      except OSError:
+        continue
+      entries.append((name.endswith('.v{0}'.format(self.version)), stat.st_mtime, stat.st_size, path))
+
+    size = sum(entry[2] for entry in entries)
+    for _, _, entry_size, path in sorted(entries):
+      if size <= self.max_size:
+        break
+      self.remove(path)
+      size -= entry_size
+
+  def remove(self, path):
+    try:
+      os.remove(path)
+    except OSError:
+      pass
+
+
+# read-only workbook opened by a loading process, by (pid, filename, mtime)
+sheet_loaders = {}
+
+
+def read_sheet(excel_loader, sheet_name):
+  """Return tuple (grid, references) of sheet_name of excel_loader as
+  SheetGrid and its calculate_references()"""
+  grid = SheetGrid(sheet_name, excel_loader)
+  return grid, grid.calculate_references()
+
+
+def load_sheet(filename, sheet_name):
+  """Return read_sheet() of sheet_name of workbook filename, the sheet being
+  streamed from a read-only workbook shared by the calls of the process"""
+  key = (os.getpid(), filename, os.path.getmtime(filename))
+  if key not in sheet_loaders:
+    for excel_loader in sheet_loaders.values():
+      excel_loader.close()
+    sheet_loaders.clear()
+    sheet_loaders[key] = ExcelLoader(filename, read_only=True)
+
+  return read_sheet(sheet_loaders[key], sheet_name)
+
+
+class WorkbookModel:
+  current_sheet_name = None
+
+  def __init__(self):
+    self.names = []
+    self.sheet_grids = {}
+
+  def load_file(self, filename, progress=None, jobs=None, cache=None):
+    """Load all sheets of workbook filename into categorised and scanned grids.
+
+    Sheets are parsed and their references calculated by a pool of jobs
+    processes (all cores if None, in process if 1), only applying the
+    references across sheets is serial. progress is called as
+    progress(loaded sheets, sheets) after each sheet.
+    If cache (a WorkbookCache) is given, the grids are restored from it if
+    the file was loaded before and stored in it otherwise."""
+    if cache and self.load_cached(filename, cache):
+      if progress:
+        progress(len(self.names), len(self.names))
+      return
+
+    refs = {}
+    for sheet_name, grid, references in self.load_sheets(filename, jobs):
+      self.sheet_grids[sheet_name] = grid
+      refs[sheet_name] = references
+      if progress:
+        progress(len(refs), len(self.sheet_names()))
+
+    self.link(refs)
+    if cache:
+      cache.put(filename, self.names, self.sheet_grids)
+
+  def load_cached(self, filename, cache):
+    """Restore the grids of workbook filename from cache, return False if
+    it is not cached"""
+    cached = cache.get(filename)
+    if cached is None:
+      return False
+
+    self.names, self.sheet_grids = cached
+    self.current_sheet_name = self.names and self.names[0] or None
+    return True
+
+  def load_sheets(self, filename, jobs=None):
+    """Open workbook filename and return generator for tuples (sheet_name,
+    grid, references) of its sheets in the order they finish loading, see
+    load_file. The grids are not added to sheet_grids and not linked yet.
+    Closing the generator cancels the sheets not loaded.
+
+    The pool starts fresh processes instead of forking, as the caller may be
+    a thread (the GUI's LoadThread) and the fork would copy its locks."""
+    excel_loader = ExcelLoader(filename, read_only=True)
+    try:
+      sheet_names = self.names = excel_loader.sheet_names()
+      self.sheet_grids = {}
+      self.current_sheet_name = sheet_names and sheet_names[0] or None
+
+      if not sheet_names:
+        return
+
+      jobs = min(jobs or os.cpu_count() or 1, len(sheet_names))
+
+      if jobs == 1:
+        for sheet_name in sheet_names:
+          yield (sheet_name,) + read_sheet(excel_loader, sheet_name)
+        return
+    finally:
+      excel_loader.close()
+
+    executor = concurrent.futures.ProcessPoolExecutor(
+      max_workers=jobs, mp_context=multiprocessing.get_context('spawn')
+    )
+    try:
+      futures = {
+        executor.submit(load_sheet, filename, sheet_name): sheet_name
+        for sheet_name in sheet_names
+      }
+      for future in concurrent.futures.as_completed(futures):
+        yield (futures[future],) + future.result()
+    finally:
+      executor.shutdown(wait=False, cancel_futures=True)
+
+  def link(self, refs):
+    """Apply dict (sheet_name -> references calculated for that sheet) to the
+    referenced sheets and scan the blocks of all sheets"""
+    self.sheet_grids = {name: self.sheet_grids[name] for name in self.sheet_names()}
+
+    # category transitions do not depend on the order references are applied
+    for sheet_name in self.sheet_grids:
+      for ref, rects in refs[sheet_name].items():
+        # references to other workbooks or sheet ranges are not followed
+        if ref in self.sheet_grids:
+          self.sheet_grids[ref].apply_references(rects)
+
+    for sheet in self.sheet_grids:
+      self.sheet_grids[sheet].update()
+
+  def set_sheet_by_index(self, index):
+    self.current_sheet_name = self.names[index]
+
+  def sheet_names(self):
+    return self.names
+
+  def current_sheet_grid(self):
+    return self.sheet_grids[self.current_sheet_name]
+
+
+def workbook_names(filenames):
+  """Return list of unique names for the workbooks filenames, their base
+  name with extension, numbered from -2 on if the same base name occurs
+  before (ignoring case)"""
+  taken = set(os.path.basename(filename).lower() for filename in filenames)
+  names, used = [], set()
+  for filename in filenames:
+    base = os.path.basename(filename)
+    name, number = base, 1
+    while name.lower() in used or (number > 1 and name.lower() in taken):
+      number += 1
+      name = '{0}-{1}'.format(base, number)
+    used.add(name.lower())
+    names.append(name)
+  return names
+
+
+def process_workbook(filename, cache_directory=None, directory='tmp', format='csv', name=None):
+  """Categorise, scan and export a workbook to directory without any GUI,
+  using the WorkbookCache in cache_directory if given.
+  The format 'hdf5' writes all blocks into the single file <name>.h5,
+  other formats write a file per block into the subdirectory name, name
+  being the base name of filename if not given.
+  Return tuple (filename, number of sheets, list of exported blocks)"""
+  cache = cache_directory and WorkbookCache(cache_directory) or None
+  workbook_model = WorkbookModel()
+  workbook_model.load_file(filename, jobs=1, cache=cache)
+
+  name = name or os.path.basename(filename)
+  if format == 'hdf5':
+    written = write_hdf5(os.path.join(directory, name + '.h5'), workbook_model)
+  else:
+    os.makedirs(os.path.join(directory, name), exist_ok=True)
+    written = export_workbook(workbook_model, os.path.join(directory, name), format)
+
+  return (filename, len(workbook_model.sheet_names()), written)
+
+
+def batch(argv):
+  """Headless entry point, process all given workbooks and return exit code"""
+  parser = argparse.ArgumentParser(
+    prog='{0} batch'.format(sys.argv[0]),
+    description='Categorise workbooks, scan their blocks and export them.'
+  )
+  parser.add_argument('files', nargs='+', metavar='FILE')
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+    help='number of workbooks processed in parallel (default: 1)')
+  parser.add_argument('--cache', metavar='DIR',
+    help='reuse workbooks loaded before from the cache in DIR')
+  parser.add_argument('-o', '--output', metavar='DIR', default='tmp',
+    help='directory the blocks are exported to (default: tmp)')
+  parser.add_argument('-f', '--format', choices=sorted(EXPORT_FORMATS) + ['hdf5'], default='csv',
+    help='export format (default: csv)')
+  args = parser.parse_args(argv)
+
+  if args.jobs < 1:
+    parser.error('--jobs must be at least 1')
+  if args.format == 'hdf5' and h5py is None:
+    parser.error('--format hdf5 needs h5py and numpy')
+
+  os.makedirs(args.output, exist_ok=True)
+
+  failed = 0
+
+  with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+    futures = [executor.submit(process_workbook, filename, args.cache, args.output, args.format, name)
+      for filename, name in zip(args.files, workbook_names(args.files))]
+
+    for filename, future in zip(args.files, futures):
+      try:
+        _, sheets, written = future.result()
+      except Exception as e:
+        failed += 1
+        print('{0}: failed: {1}'.format(filename, e), file=sys.stderr)
+        continue
+      print('{0}: {1} sheets, {2} blocks exported'.format(filename, sheets, len(written)))
+
+  return failed and 1 or 0
+
+
+if __name__ == '__main__':
+  if sys.argv[1:2] != ['batch']:
+    sys.exit('Usage: {0} batch [--jobs N] [--cache DIR] [--output DIR] [--format FORMAT] files...'.format(sys.argv[0]))
+  sys.exit(batch(sys.argv[2:]))
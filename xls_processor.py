@@ -2,105 +2,25 @@
 
 import os
 import sys
-import re
-import csv
-import math
+
+if __name__ == '__main__' and sys.argv[1:2] == ['batch']:
+  # headless, Qt is neither needed nor imported
+  import xls_model
+  sys.exit(xls_model.batch(sys.argv[2:]))
 
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 
-import openpyxl
-from tokenizer import shunting_yard
+import xls_model
+from xls_model import *
 
 import collections
 
-import random
-import string
-
-#import h5py
-#import numpy as np
-
 #import apihelper
 
 import stopwatch
 
-import warnings
-warnings.filterwarnings("ignore")
-
-
-if sys.version_info < (3,):
-  def is_string(s):
-    return type(s) in [str, unicode]
-else:
-  def is_string(s):
-    return type(s) == str
-
-
-def randomword(length):
-  return ''.join(random.choice(string.ascii_lowercase) for i in range(length))
-
-
-def slugify(value):
-  import unicodedata
-  value = unicodedata.normalize('NFKD', value)
-  value = re.sub('[^\w\s-]', '', value).strip().lower()
-  return re.sub('[-\s]+', '-', value)
-
-
-class ExcelLoader:
-  def __init__(self, filename):
-    self.workbook_normal = openpyxl.load_workbook(filename, data_only=False)
-    #self.workbook_data = openpyxl.load_workbook(filename, data_only=True)
-
-  def iter_rows(self, sheet_name, data_only=True):
-    #wb = data_only and self.workbook_data or self.workbook_normal
-    wb = self.workbook_normal
-    sheet = wb[sheet_name]
-    return sheet.iter_rows()
-
-  def iter_icells(self, sheet_name, data_only=True):
-    """Return generator for all cells with offsets prepended"""
-    #wb = data_only and self.workbook_data or self.workbook_normal
-    wb = self.workbook_normal
-    sheet = wb[sheet_name]
-
-    for i, row in enumerate(sheet.iter_rows()):
-      for j, cell in enumerate(row):
-        if not cell:
-          continue
-        yield (i, j, cell)
-
-  def sheet_names(self):
-    return self.workbook_normal.get_sheet_names()
-
-
-class ExcelFormula:
-  @staticmethod
-  def all_cell_coordinates(formula):
-    rpn = shunting_yard(formula)
-    for node in rpn:
-      if node.token.ttype == 'operand' and node.token.tsubtype == 'range':
-        yield node.token.tvalue
-
-  @staticmethod
-  def expand_cell_range(cell_range):
-    """Return generator for offsets (tuples) of expanded cell range"""
-    m = re.match(r'([A-Z]+[0-9]+):([A-Z]+[0-9]+)', cell_range)
-    a = ExcelFormula.offsets_from_coordinates(m.group(1))
-    b = ExcelFormula.offsets_from_coordinates(m.group(2))
-
-    for i in range(a[0], b[0]+1):
-      for j in range(a[1], b[1]+1):
-        yield (i,j)
-
-  @staticmethod
-  def offsets_from_coordinates(coordinates):
-    xy = openpyxl.utils.coordinate_from_string(coordinates) 
-    col = openpyxl.utils.column_index_from_string(xy[0])
-    row = xy[1] 
-    return (row-1,col-1)
-
 
 class CellData:
   Data = Qt.UserRole+1
@@ -110,27 +30,7 @@ class CellData:
   SetCategory = Qt.UserRole+5
   Border = Qt.UserRole+6
 
-class CellCategory:
-  Empty = 0
-  Label = 1
-  Input = 2
-  Output = 3
-  Intermediate = 4
-  Ignored = 5
-
-  Any = 6
-
-  @classmethod
-  def desc(self, category):
-    return {
-      self.Empty: 'Empty',
-      self.Label: 'Label',
-      self.Input: 'Input',
-      self.Output: 'Output',
-      self.Intermediate: 'Intermediate',
-      self.Ignored: 'Ignored'
-    }[category]
-
+class CellCategory(xls_model.CellCategory):
   @classmethod
   def color(self, category):
     return {
@@ -142,17 +42,6 @@ class CellCategory:
       self.Ignored: QColor(220,220,250)
     }[category]
 
-  @classmethod
-  def categories(self):
-    return [
-      self.Empty,
-      self.Label,
-      self.Input,
-      self.Output,
-      self.Intermediate,
-      self.Ignored
-    ]
-
 
 class CellBorder:
   NoBorder = 0
@@ -162,308 +51,161 @@ class CellBorder:
   Bottom = 8
   All = Top | Left | Right | Bottom
 
-class Direction:
-  Left = 0
-  Right = 1
-  Top = 2
-  Bottom = 3
-
+class SheetModel(QAbstractTableModel):
+  """Virtual Qt table model on top of a SheetGrid.
 
-class Block:
-  def __init__(self, model, top_left=(0,0), bottom_right=(0,0), type_=CellCategory.Label):
-    self.top_left = top_left
-    self.bottom_right = bottom_right
-    self.type_ = type_
-    self.model = model
+  No per-cell Qt objects are created, data() reads from the grid on demand.
+  Display texts of recently painted rows are kept in a small row cache."""
+  cache_rows = 256
 
-    #print('{0}: {1}'.format(self.top_left, self.get_data(*self.top_left)))
-
-  def get_data(self, row, column):
-    return self.model.index(row + self.top_left[0], column + self.top_left[1]).data(CellData.Data)
-
-  def dimensions(self):
-    (ax, ay), (bx, by) = self.top_left, self.bottom_right
-    return (bx-ax+1, by-ay+1)
-
-  def row(self):
-    return self.top_left[0]
-
-  def column(self):
-    return self.top_left[1]
-
-  def row_count(self):
-    return self.dimensions()[0]
-
-  def column_count(self):
-    return self.dimensions()[1]
-
-
-class Blocks:
-  def __init__(self):
-    self.blocks = []
-
-  def clear(self):
-    del self.blocks[:]
-
-  def add_block(self, block):
-    self.blocks.append(block)
-
-  def indices(self):
-    return self.blocks
-
-  def data_blocks(self):
-    for  block in self.blocks:
-      if block.type_ in [CellCategory.Input, CellCategory.Output, CellCategory.Intermediate]:
-        yield block
-
-  def next_block(self, block, direction, position=(-1,-1), dimensions=(0,0), type_=CellCategory.Any):
-    matching_blocks = []
-
-    for bl in self.blocks:
-      if type_ != CellCategory.Any and bl.type_ != type_:
-        continue
-
-      if (dimensions[0] != 0 and dimensions[0] != bl.row_count()) or \
-        (dimensions[1] != 0 and dimensions[1] != bl.column_count()):
-        continue
-
-      if (position[0] != -1 and position[0] != bl.row()) or \
-        (position[1] != -1 and position[1] != bl.column()):
-        continue
-
-      if (direction == Direction.Top and block.row() <= bl.row()) or \
-        (direction == Direction.Bottom and block.row() >= bl.row()) or \
-        (direction == Direction.Left and block.column() <= bl.column()) or \
-        (direction == Direction.Right and block.column() >= bl.column()):
-        continue
-
-      row_d, col_d = abs(block.row()-bl.row()), abs(block.column()-bl.column())
-      distance = math.sqrt(pow(row_d, 2) + pow(col_d, 2))
-      matching_blocks.append((distance, bl))
-
-    sorted_blocks = sorted(matching_blocks, key=lambda x: x[0])
-
-    if sorted_blocks:
-      return sorted_blocks[0][1]
-    else:
-      return None
-
-
-  def export(self, filename):
-    for block in self.data_blocks():
-      label_block = self.next_block(
-        block, Direction.Left, (-1, -1), (block.row_count(), 1), CellCategory.Label
-      )
-      index_block = self.next_block(
-        block, Direction.Top, (-1, -1), (0, block.column_count()), CellCategory.Label
-      )
-  
-      if not (label_block and index_block):
-        continue
-
-      title_block = self.next_block(
-        block, Direction.Top, (-1,-1), (0,0),  CellCategory.Any
-      )
-      if title_block.dimensions() == (1,1) and title_block.type_ == CellCategory.Label:
-        title = title_block.get_data(0,0)
-      else:
-        title_block = self.next_block(
-          block, Direction.Left, (-1,-1), (0,0), CellCategory.Any
-        )
-        if title_block.dimensions() == (1,1) and title_block.type_ == CellCategory.Label:
-          title = title_block.get_data(0,0)
-        else:
-          title = randomword(10)
-           
-      filename = slugify(title) + '.csv'
-
-      os.chdir('tmp')
-      with open(filename, 'w', newline='') as f:
-        a = csv.writer(f)
-
-        index_data = []
-        rows, columns = index_block.dimensions()
-        for i in range(columns):
-          index_data.append(index_block.get_data(rows-1,i))
-
-        row_data = ['Index']
-        w,h = label_block.dimensions()
-        for i in range(w):
-          for j in range(h):
-            row_data.append(label_block.get_data(i,j))
-        a.writerow(row_data)
-
-        rows, columns = block.dimensions()
-        for i in range(columns):
-          row_data = [index_data[i]]
-          for j in range(rows):
-            row_data.append(block.get_data(j,i))
-          a.writerow(row_data)
-
-      os.chdir('..')
-
-
-class SheetModel(QStandardItemModel):
-  def __init__(self, sheet_name, excel_loader, parent=None):
+  def __init__(self, grid, parent=None):
     super(SheetModel, self).__init__(parent)
 
-    self.excel_loader = excel_loader
-    self.sheet_name = sheet_name
-
-    self.blocks = Blocks()
-
-    for row in self.excel_loader.iter_rows(sheet_name, data_only=False):
-      row_items = []
-      for cell in row:
-
-        if cell.value != None:
-          if is_string(cell.value):
-            text = cell.value.strip()  
-          else:
-            text = str(cell.value)
-        else:
-          text = ''
-
-        item = QStandardItem(text)
-
-        item.setData(cell.value, CellData.Data)
-        item.setData(CellBorder.NoBorder, CellData.Border)
-        item.setData(-1, CellData.SetCategory)
-        item.setData(
-          text and CellCategory.Label or CellCategory.Empty,
-          CellData.Category
-        )
-
-        if cell.formula:
-          item.setData(cell.formula, CellData.Expression)
-
-        row_items.append(item)
-
-      self.appendRow(row_items)
-
-
-  def calculate_references(self):
-    """Return dict (sheet_name -> cell references to that sheet)"""
-    refs = {}
-    for i in range(self.rowCount()):
-      for j in range(self.columnCount()):
-        text = self.data(self.index(i,j), CellData.Expression)
-        if not text:
-          continue
+    self.grid = grid
+    self.sheet_name = grid.sheet_name
+    self.blocks = grid.blocks
+
+    self.row_cache = collections.OrderedDict()
+    self.update_borders()
+
+  def rowCount(self, parent=QModelIndex()):
+    if parent.isValid():
+      return 0
+    return self.grid.row_count
+
+  def columnCount(self, parent=QModelIndex()):
+    if parent.isValid():
+      return 0
+    return self.grid.column_count
+
+  def row_texts(self, row):
+    """Return display texts of a row, formatting it on first access"""
+    texts = self.row_cache.get(row)
+    if texts is not None:
+      self.row_cache.move_to_end(row)
+      return texts
+
+    k = self.grid.offset(row, 0)
+    texts = [cell_text(value) for value in self.grid.values[k:k+self.grid.column_count]]
+
+    self.row_cache[row] = texts
+    if len(self.row_cache) > self.cache_rows:
+      self.row_cache.popitem(last=False)
+    return texts
+
+  def update(self, rows=None):
+    """Rescan blocks, only around rows (first, last) if given"""
+    removed, added = self.grid.update(rows)
+
+    if rows is None:
+      self.update_borders()
+      self.cells_changed()
+      return
 
-        if is_string(text) and text.startswith('='):
-          self.setData(self.index(i,j), CellCategory.Output, CellData.Category)
+    for block in removed:
+      for cell, border in self.block_borders(block):
+        self.borders.pop(cell, None)
+    for block in added:
+      self.add_borders(block)
 
-          cell_coordinates = ExcelFormula.all_cell_coordinates(text)
+    changed = removed + added
+    self.cells_changed(
+      min([rows[0]] + [b.row() for b in changed]),
+      max([rows[1]] + [b.bottom_right[0] for b in changed])
+    )
 
-          for cc in cell_coordinates:
-              #print('{2} ({0},{1}): {3}'.format(i,j,self.sheet_name, cc))
-              m = re.match(r'(([^!]+)\!)?([A-Z]+[0-9]+)(:[A-Z]+[0-9]+)?', cc)
+  def reset_categories(self):
+    self.grid.reset_categories()
+    self.update_borders()
+    self.cells_changed()
 
-              if not m:
-                # cell is error!
-                self.setData(self.index(i,j), '\''+text, CellData.Expression)
-                self.setData(self.index(i,j), '\''+text, CellData.Data)
-                self.item(i,j).setText(text)
-                break
+  @staticmethod
+  def block_borders(block):
+    """Return generator for tuples (cell, CellBorder) along the edges of block"""
+    (ax, ay), (bx, by) = block.top_left, block.bottom_right
+    for x in range(ax, bx+1):
+      yield (x, ay), CellBorder.Left
+      yield (x, by), CellBorder.Right
+    for y in range(ay, by+1):
+      yield (ax, y), CellBorder.Top
+      yield (bx, y), CellBorder.Bottom
+
+  def add_borders(self, block):
+    for cell, border in self.block_borders(block):
+      self.borders[cell] = self.borders.get(cell, CellBorder.NoBorder) | border
+
+  def update_borders(self):
+    """Rebuild the map (row, column) -> CellBorder from the current blocks"""
+    self.borders = {}
+    for block in self.blocks.indices():
+      self.add_borders(block)
+
+  def cells_changed(self, first_row=0, last_row=None):
+    if last_row is None:
+      last_row = self.rowCount()-1
+    if last_row >= first_row and self.columnCount():
+      self.dataChanged.emit(self.index(first_row, 0), self.index(last_row, self.columnCount()-1))
+
+  def insert_row(self, row):
+    self.beginInsertRows(QModelIndex(), row, row)
+    self.grid.insert_row(row)
+    self.row_cache.clear()
+    self.endInsertRows()
+    # the blocks below moved, their borders with them
+    self.update_borders()
+    self.cells_changed()
+
+  def remove_row(self, row):
+    self.beginRemoveRows(QModelIndex(), row, row)
+    self.grid.remove_row(row)
+    self.row_cache.clear()
+    self.endRemoveRows()
+    self.update_borders()
+    self.cells_changed()
 
-              sheet_name = m.group(2) or self.sheet_name
-              ref = m.group(3) + (m.group(4) or '')
+  def get_category(self, index):
+    return self.grid.get_category(index.row(), index.column())
+
+  def setData(self, index, value, role=Qt.EditRole):
+    if not index.isValid():
+      return False
+
+    k = self.grid.offset(index.row(), index.column())
+
+    if role in [CellData.Data, Qt.EditRole]:
+      self.grid.values[k] = value
+      self.row_cache.pop(index.row(), None)
+    elif role == CellData.Expression:
+      self.grid.formulas[k] = value
+    elif role == CellData.Category:
+      self.grid.categories[k] = value
+    elif role == CellData.SetCategory:
+      self.grid.set_categories[k] = value
+    else:
+      return False
 
-              if not sheet_name in refs: refs[sheet_name] = []
-              refs[sheet_name].append(ref)
+    self.dataChanged.emit(index, index)
+    return True
 
-    return refs
+  def data(self, index, role=Qt.DisplayRole):
+    if not index.isValid():
+      return None
 
-  def apply_references(self, refs):
-    for ref in refs:
-      if ':' in ref:
-        indices = [self.index(*ret) for ret in ExcelFormula.expand_cell_range(ref)]
-      else:
-        indices = [self.index(*ExcelFormula.offsets_from_coordinates(ref))]
+    if role in [Qt.DisplayRole, Qt.EditRole]:
+      return self.row_texts(index.row())[index.column()]
 
-      for index in indices:
-        if not index:
-          continue
-        current_category = self.data(index, CellData.Category)
-        if current_category == CellCategory.Output:
-          self.setData(index, CellCategory.Intermediate, CellData.Category)
-        elif self.data(index, CellData.Category) == CellCategory.Label:
-          self.setData(index, CellCategory.Input, CellData.Category)
+    if role == CellData.Data:
+      return self.grid.value(index.row(), index.column())
 
-  def update(self):
-    #self.blocks = list(self.scan_blocks())
-    self.blocks.clear()
-    [self.blocks.add_block(b) for b in self.scan_blocks()]
+    if role == CellData.Expression:
+      return self.grid.formula(index.row(), index.column())
 
-  def reset_categories(self):
-    for col in range(self.columnCount()):
-      for row in range(self.rowCount()):
-        self.setData(self.index(row, col), -1, CellData.SetCategory)
-    self.update()
-
-  def scan_blocks(self):
-    def row_sections(row):
-      start = 0
-      for x in range(self.columnCount()):
-        #cat = self.data(self.index(row, x), CellData.Category)
-        cat = self.get_category(self.index(row, x))
-
-        x_next = x+1
-
-        if cat == CellCategory.Empty:
-          start = x_next
-          continue
-
-        if (x_next>self.columnCount()-1 or
-             #self.data(self.index(row, x_next), CellData.Category) != cat):
-             self.get_category(self.index(row, x_next)) != cat):
-          yield (start, x)
-          start = x_next
-
-    all_rows = []
-    for i in range(self.rowCount()):
-      all_rows.append(list(row_sections(i)))
-      
-    blacklist = {}
-
-    for i, row in enumerate(all_rows):
-      for sec in row:
-        blacklist = {b: blacklist[b] for b in blacklist if i<=blacklist[b]}
-
-        if sec in blacklist:
-          continue
-
-        k = i
-        while True:
-          if k+1 >= self.rowCount(): 
-            break
-
-          flag = False
-          for m in all_rows[k+1]:
-            if m==sec:
-              flag = self.get_category(self.index(k+1, m[0])) == \
-                     self.get_category(self.index(i, sec[0]))
-#              flag = self.index(k+1,m[0]).data(CellData.Category) == \
-#                    self.index(i,sec[0]).data(CellData.Category)
-              break
-          if not flag:
-            break
-
-          k += 1
-          blacklist[sec] = k
-
-        #cat = self.data(self.index(i, sec[0]), CellData.Category)
-        cat = self.get_category(self.index(i, sec[0]))
-        yield Block(self, (i, sec[0]), (k, sec[1]), cat)
+    if role == CellData.Category:
+      return self.grid.categories[self.grid.offset(index.row(), index.column())]
 
-  def get_category(self, index):
-    ret = self.data(index, CellData.SetCategory)
-    if ret == -1:
-      ret = self.data(index, CellData.Category)
-    return ret
+    if role == CellData.SetCategory:
+      return self.grid.set_categories[self.grid.offset(index.row(), index.column())]
 
-  def data(self, index, role):
     if role == Qt.BackgroundRole:
       category = self.get_category(index)
 
@@ -480,58 +222,10 @@ class SheetModel(QStandardItemModel):
       return QColor(255,255,255)
 
     if role == CellData.Border:
-      border = CellBorder.NoBorder
-      x,y = index.row(), index.column()
-
-      for block in self.blocks.indices():
-        (ax, ay), (bx, by) = block.top_left, block.bottom_right
-        if x>=ax and x<=bx:
-          if y==ay:
-            border |= CellBorder.Left   
-          if y==by:
-            border |= CellBorder.Right
-        if y>=ay and y<=by:
-          if x==ax:
-            border |= CellBorder.Top
-          if x==bx:
-            border |= CellBorder.Bottom
-      return border
-   
-    return super(SheetModel, self).data(index, role)
-
-
-class WorkbookModel:
-  def load_file(self, filename):
-    self.excel_loader = ExcelLoader(filename)
-
-    sheet_names = self.excel_loader.sheet_names()
-    self.sheet_models = {}
-
-    if not sheet_names:
-      return
-
-    for sheet_name in sheet_names:
-      self.sheet_models[sheet_name] = SheetModel(sheet_name, self.excel_loader)
-
-    for sheet in self.sheet_models:
-      refs = self.sheet_models[sheet].calculate_references()
-      for ref in refs:
-        self.sheet_models[ref].apply_references(refs[ref])
-
-    for sheet in self.sheet_models:
-      self.sheet_models[sheet].update()
-
-    self.current_sheet_name = sheet_names[0]
-
-  def set_sheet_by_index(self, index):
-    sheet_names = self.excel_loader.sheet_names()
-    self.current_sheet_name = sheet_names[index]
+      return self.borders.get((index.row(), index.column()), CellBorder.NoBorder)
 
-  def sheet_names(self):
-    return self.excel_loader.sheet_names()
+    return None
 
-  def current_sheet_model(self):
-    return self.sheet_models[self.current_sheet_name]
 
 def intensify(qcolor):
   hsv = qcolor.getHsv()
@@ -640,7 +334,8 @@ class TableView(QTableView):
     for ix in indexes:
       #if ix.data(CellData.Category) != CellCategory.Empty:
       self.model().setData(ix, qaction.data(), CellData.SetCategory)
-    self.model().update()
+    rows = [ix.row() for ix in indexes]
+    self.model().update((min(rows), max(rows)))
   
 
   def update_hovered(self, pos):
@@ -694,12 +389,13 @@ class TableView(QTableView):
       pass
     elif what == 'add row':
       if rows == 1:
-        self.model().insertRow(y+1)
+        self.model().insert_row(y+1)
     elif what == 'add column':
       pass
     elif what == 'delete row':
-      for i in range(ymin, ymax+1):
-        self.model().takeRow(i)
+      # the rows below move up after each removal
+      for _ in range(ymin, ymax+1):
+        self.model().remove_row(ymin)
     elif what == 'delete column':
       pass
 
@@ -823,12 +519,61 @@ class SubToolBar(MyToolBar):
   def update(self):
     pass
 
+class LoadThread(QThread):
+  """Load a workbook into a new WorkbookModel, link its sheets and store it
+  in the cache, emitting the progress after each sheet. The GUI thread only
+  takes the finished model."""
+  sheet_loaded = pyqtSignal(int, int)
+
+  def __init__(self, filename, cache=None, parent=None):
+    super(LoadThread, self).__init__(parent)
+    self.filename = filename
+    self.cache = cache
+    self.cached = False
+    self.workbook_model = WorkbookModel()
+    self.error = None
+
+  def run(self):
+    try:
+      self.load()
+    except Exception as e:
+      self.error = e
+
+  def load(self):
+    """WorkbookModel.load_file, stopping at the next sheet if interrupted"""
+    self.cached = bool(self.cache) and self.workbook_model.load_cached(self.filename, self.cache)
+    if self.cached:
+      names = self.workbook_model.sheet_names()
+      self.sheet_loaded.emit(len(names), len(names))
+      return
+
+    refs = {}
+    sheets = self.workbook_model.load_sheets(self.filename)
+    try:
+      for sheet_name, grid, references in sheets:
+        if self.isInterruptionRequested():
+          return
+        self.workbook_model.sheet_grids[sheet_name] = grid
+        refs[sheet_name] = references
+        self.sheet_loaded.emit(len(refs), len(self.workbook_model.sheet_names()))
+    finally:
+      sheets.close()
+
+    self.workbook_model.link(refs)
+    if self.cache:
+      self.cache.put(self.filename, self.workbook_model.sheet_names(), self.workbook_model.sheet_grids)
+
+
 class MainWindow(QMainWindow):
   def __init__(self, parent=None):
     super(MainWindow, self).__init__(parent)
     self.setWindowTitle('XLS Processor')
  
     self.workbook_model = WorkbookModel()
+    self.sheet_models = {}
+    self.loader = None
+    self.filename = None
+    self.cache = WorkbookCache()
     self.setupUI()
 
   def setupUI(self):
@@ -857,7 +602,15 @@ class MainWindow(QMainWindow):
     self.statusLabel.setFrameStyle(QFrame.Panel | QFrame.Sunken)
     self.cellinfoLabel.setFrameStyle(QFrame.Panel | QFrame.Sunken)
 
+    self.progressBar = QProgressBar()
+    self.progressBar.hide()
+    self.cancelButton = QPushButton('Cancel')
+    self.cancelButton.clicked.connect(self.cancel_loading)
+    self.cancelButton.hide()
+
     self.statusBar().addPermanentWidget(self.statusLabel, 2)
+    self.statusBar().addPermanentWidget(self.progressBar, 1)
+    self.statusBar().addPermanentWidget(self.cancelButton)
     self.statusBar().addPermanentWidget(self.cellinfoLabel, 1)
 
     colordict = collections.OrderedDict()
@@ -885,7 +638,7 @@ class MainWindow(QMainWindow):
     self.subtoolbar.load(qaction.data())
  
   def reset_categories(self):
-    self.workbook_model.current_sheet_model().reset_categories()
+    self.table.model().reset_categories()
 
   def set_category(self, qaction):
     selmodel = self.table.selectionModel()
@@ -897,13 +650,29 @@ class MainWindow(QMainWindow):
     for ix in indexes:
       #if ix.data(CellData.Category) != CellCategory.Empty:
       self.table.model().setData(ix, qaction.data(), CellData.SetCategory)
-    self.table.model().update()
+    rows = [ix.row() for ix in indexes]
+    self.table.model().update((min(rows), max(rows)))
 
   def table_action(self, qaction):
     self.table.do(qaction.data())
 
   def export(self):
-    self.table.model().blocks.export('out.hd5')
+    if not self.filename:
+      return
+
+    name = os.path.basename(self.filename)
+    if xls_model.h5py is None:
+      directory = os.path.join('tmp', name)
+      os.makedirs(directory, exist_ok=True)
+      written = export_workbook(self.workbook_model, directory)
+      self.status_message('h5py is not installed, {0} blocks exported to {1} as CSV'.format(len(written), directory))
+      return
+
+    os.makedirs('tmp', exist_ok=True)
+
+    path = os.path.join('tmp', name + '.h5')
+    written = write_hdf5(path, self.workbook_model)
+    self.status_message('{0} blocks exported to {1}'.format(len(written), path))
 
   def status_message(self, msg, timeout=4000):
     self.statusLabel.setText(msg)
@@ -923,26 +692,97 @@ class MainWindow(QMainWindow):
     self.cellinfoLabel.setText(text)
 
   def tab_changed(self, index):
+    if index < 0:
+      return
     self.workbook_model.set_sheet_by_index(index)
     self.update_table()
 
   def update_tabbar(self):
+    # tabs of the previous workbook do not belong to the current model
+    self.tabs.blockSignals(True)
     while self.tabs.count()>0:
       self.tabs.removeTab(0)
+    self.tabs.blockSignals(False)
 
     for name in self.workbook_model.sheet_names():
       self.tabs.addTab(name.replace('&','&&'))
 
   def update_table(self):
-    self.table.setModel(self.workbook_model.current_sheet_model())
+    grid = self.workbook_model.sheet_grids.get(self.workbook_model.current_sheet_name)
+    if grid is None:
+      # no sheets
+      self.table.setModel(None)
+      return
+    if grid.sheet_name not in self.sheet_models:
+      self.sheet_models[grid.sheet_name] = SheetModel(grid)
+    self.table.setModel(self.sheet_models[grid.sheet_name])
 
   def load_workbook(self, filename):
+    self.cancel_loading()
     self.status_message('Loading file \'{0}\'...'.format(filename), timeout=0)
-    QApplication.processEvents()
-    self.workbook_model.load_file(filename)
+
+    self.loader = LoadThread(filename, self.cache, self)
+    self.loader.sheet_loaded.connect(self.sheet_loaded)
+    self.loader.finished.connect(self.loading_finished)
+
+    self.progressBar.setValue(0)
+    self.progressBar.show()
+    self.cancelButton.show()
+    self.loader.start()
+
+  def sheet_loaded(self, loaded, total):
+    if self.sender() is not self.loader:
+      return
+    self.progressBar.setMaximum(total)
+    self.progressBar.setValue(loaded)
+
+  def loading_finished(self):
+    loader = self.sender()
+    loader.deleteLater()
+    if loader is not self.loader:
+      return
+
+    self.loader = None
+    self.progressBar.hide()
+    self.cancelButton.hide()
+
+    if loader.error:
+      self.close_workbook()
+      self.status_message('Loading \'{0}\' failed: {1}'.format(loader.filename, loader.error))
+      return
+
+    self.workbook_model = loader.workbook_model
+    self.sheet_models = {}
+    self.filename = loader.filename
+    self.update_tabbar()
+    self.update_table()
+    self.status_message('\'{0}\' loaded.'.format(loader.filename))
+
+  def cancel_loading(self):
+    """Stop loading a workbook, the partly loaded workbook is closed"""
+    if not self.loader:
+      return
+
+    # the thread finishes the sheet at hand in the background
+    self.loader.requestInterruption()
+    self.loader = None
+    self.progressBar.hide()
+    self.cancelButton.hide()
+    self.close_workbook()
+    self.status_message('Loading cancelled.')
+
+  def close_workbook(self):
+    self.workbook_model = WorkbookModel()
+    self.sheet_models = {}
+    self.filename = None
+    self.table.setModel(None)
     self.update_tabbar()
-    self.status_message('\'{0}\' loaded.'.format(filename))
 
+  def closeEvent(self, event):
+    for loader in self.findChildren(LoadThread):
+      loader.requestInterruption()
+      loader.wait()
+    super(MainWindow, self).closeEvent(event)
 
   def open_file(self):
     settings = QSettings()
@@ -958,11 +798,11 @@ class MainWindow(QMainWindow):
     settings.setValue('default_dir', directory)
     self.load_workbook(filename)
 
-    
+
 
 if __name__ == '__main__':
   if len(sys.argv) > 2:
-    sys.exit('Usage: {0} [filename]'.format(sys.argv[0]))
+    sys.exit('Usage: {0} [filename]\n       {0} batch [--jobs N] files...'.format(sys.argv[0]))
 
   app = QApplication(sys.argv)
   app.aboutToQuit.connect(app.deleteLater)
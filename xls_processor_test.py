@@ -1,7 +1,18 @@
 #!/usr/bin/env python3
 
+import os
+import csv
+import glob
 import unittest
-from xls_processor import Block, Blocks, CellCategory, Direction
+import random
+import tempfile
+from unittest import mock
+from array import array
+import xls_model
+from tokenizer import ExcelParser, shunting_yard, shunting_yard_batch
+from xls_processor import Block, Blocks, CellCategory, Direction, ExcelFormula, ExcelLoader, ExportTable, SheetGrid, WorkbookCache, WorkbookModel, hdf5_data, is_string, process_workbook, read_columnar, write_columnar, write_csv, write_hdf5, workbook_names
+
+workbooks = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xls', '*.xls*')))
 
 class KnownBlocks(unittest.TestCase):
   known_blocks = (
@@ -38,6 +49,358 @@ class KnownBlocks(unittest.TestCase):
     nb = blocks.next_block(block, Direction.Left, (block.row(), -1), (block.row_count(), 1), CellCategory.Label)
     self.assertBlockEqual(self.known_blocks[3][0], nb)
 
+  def test_next_block_index(self):
+    def nearest(blocks, block, direction, type_):
+      candidates = [
+        bl for bl in blocks
+        if (type_ == CellCategory.Any or bl.type_ == type_) and
+          ((direction == Direction.Top and bl.row() < block.row()) or
+           (direction == Direction.Bottom and bl.row() > block.row()) or
+           (direction == Direction.Left and bl.column() < block.column()) or
+           (direction == Direction.Right and bl.column() > block.column()))
+      ]
+      distance = lambda bl: pow(block.row()-bl.row(), 2) + pow(block.column()-bl.column(), 2)
+      return candidates and min(candidates, key=distance) or None
+
+    rnd = random.Random(0)
+    for _ in range(20):
+      blocks, added = Blocks(), []
+      for _ in range(50):
+        row, column = rnd.randint(0, 80), rnd.randint(0, 80)
+        block = Block(None, (row, column), (row+rnd.randint(0, 2), column), rnd.randint(1, 4))
+        blocks.add_block(block)
+        added.append(block)
+
+      for block in added:
+        for direction in [Direction.Left, Direction.Right, Direction.Top, Direction.Bottom]:
+          for type_ in [CellCategory.Any, CellCategory.Label]:
+            self.assertIs(nearest(added, block, direction, type_),
+                          blocks.next_block(block, direction, type_=type_))
+
+
+class Formulas(unittest.TestCase):
+  formulas = (
+    '=SUM(A1:B2)', '=\'My \'\'x\'\' Sheet\'!A1+B$2', '=IF(A1>0,"a""b",C3)', '=1E+5+A1',
+    '=0.5E-3', '=A1 B1', '=-A1%', '={1,2;3,4}', '=Sheet1!A1:Sheet1!B2', '=TRUE+FALSE',
+    '=LOG10(A2)', '=SUM( A1 , B2 )', '  =A1', '=A1&"unterminated', '=Q1_Sales*2',
+    '=A:A', '=[1]Sheet!A1', '=#REF!A1', '=x"a"', '=A1\'b\''
+  )
+
+  def test_range_operands(self):
+    for formula in self.formulas:
+      self.assertEqual(list(ExcelFormula.all_cell_coordinates(formula)),
+                       ExcelFormula.range_operands(formula))
+
+  def test_tokens(self):
+    def tokens(formula):
+      return [(t.tvalue, t.ttype, t.tsubtype) for t in ExcelParser().getTokens(formula).items]
+
+    self.assertEqual([
+      ('My \'x\' Sheet!A1', 'operand', 'range'), ('+', 'operator-infix', 'math'),
+      ('1E+5', 'operand', 'number')
+    ], tokens('=\'My \'\'x\'\' Sheet\'!A1+1E+5'))
+    self.assertEqual([
+      ('IF', 'function', 'start'), ('A1', 'operand', 'range'), ('>=', 'operator-infix', 'logical'),
+      ('0', 'operand', 'number'), (',', 'argument', ''), ('a"b', 'operand', 'text'),
+      (',', 'argument', ''), ('#N/A', 'operand', 'error'), ('', 'function', 'stop')
+    ], tokens('=IF(A1>=0,"a""b",#N/A)'))
+    # trailing white-space is dropped
+    self.assertEqual(tokens('={1;2}'), tokens('={1;2} '))
+
+  def test_batch(self):
+    items = list(enumerate(self.formulas + self.formulas[:5]))
+    expected = [(k, [str(node) for node in shunting_yard(formula)]) for k, formula in items]
+    for jobs in (1, 2):
+      rpns = shunting_yard_batch(items, jobs, chunk_size=4)
+      self.assertEqual(expected, [(k, [str(node) for node in rpn]) for k, rpn in rpns])
+      self.assertIs(rpns[0][1], rpns[len(self.formulas)][1])
+
+  def test_cell_references(self):
+    self.assertEqual([(None, (2, 1, 2, 7))], ExcelFormula.cell_references('=SUM(B3:H3)', 2, 9))
+    self.assertEqual([(None, (5, 1, 5, 7))], ExcelFormula.cell_references('=SUM(B6:H6)', 5, 9))
+    self.assertEqual([('S 1', (0, 0, 0, 0)), None],
+                     ExcelFormula.cell_references('=\'S 1\'!A1+$B$2+C3', 7, 7))
+    self.assertEqual([('S 1', (1, 0, 1, 0)), None],
+                     ExcelFormula.cell_references('=\'S 1\'!A2+$B$2+C4', 8, 7))
+    self.assertEqual([(None, (None, 0, None, 1)), ('S 1', (2, None, 3, None))],
+                     ExcelFormula.cell_references('=SUM(A:B)+SUM(\'S 1\'!3:4)', 1, 5))
+
+  def test_cached_references(self):
+    formulas = self.formulas + ('=SUM(A1:B2:C3)', '=SUM(B1:C2:D3)', '=A1:B2 C3', '=SUM(A:A)+B2')
+    ExcelFormula.reference_cache.clear()
+    cached = [ExcelFormula.cell_references(formula, 5, 5+k) for k, formula in enumerate(formulas)]
+    uncached = []
+    for k, formula in enumerate(formulas):
+      ExcelFormula.reference_cache.clear()
+      uncached.append(ExcelFormula.cell_references(formula, 5, 5+k))
+    self.assertEqual(uncached, cached)
+    self.assertEqual([(None, (0, 1, 1, 2))], cached[len(self.formulas)+1])
+
+  def test_apply_references(self):
+    grid = SheetGrid('S 1')
+    grid.row_count, grid.column_count = 4, 3
+    grid.categories = array('b', [CellCategory.Output, CellCategory.Label, CellCategory.Empty]*4)
+    grid.apply_references([(None, 0, None, 0), (1, 0, 2, 2), (2, 1, 9, 1)])
+    self.assertEqual([CellCategory.Intermediate, CellCategory.Label, CellCategory.Empty,
+                      CellCategory.Intermediate, CellCategory.Input, CellCategory.Empty,
+                      CellCategory.Intermediate, CellCategory.Input, CellCategory.Empty,
+                      CellCategory.Intermediate, CellCategory.Input, CellCategory.Empty],
+                     list(grid.categories))
+
+
+def legacy_scan_blocks(grid):
+  """Block scanner as originally implemented on the Qt model, kept as reference"""
+  def row_sections(row):
+    start = 0
+    for x in range(grid.column_count):
+      cat = grid.get_category(row, x)
+      x_next = x+1
+      if cat == CellCategory.Empty:
+        start = x_next
+        continue
+      if x_next > grid.column_count-1 or grid.get_category(row, x_next) != cat:
+        yield (start, x)
+        start = x_next
+
+  all_rows = [list(row_sections(i)) for i in range(grid.row_count)]
+  blacklist = {}
+
+  for i, row in enumerate(all_rows):
+    for sec in row:
+      blacklist = {b: blacklist[b] for b in blacklist if i<=blacklist[b]}
+      if sec in blacklist:
+        continue
+
+      k = i
+      while k+1 < grid.row_count:
+        flag = False
+        for m in all_rows[k+1]:
+          if m == sec:
+            flag = grid.get_category(k+1, m[0]) == grid.get_category(i, sec[0])
+            break
+        if not flag:
+          break
+        k += 1
+        blacklist[sec] = k
+
+      yield (i, sec[0]), (k, sec[1]), grid.get_category(i, sec[0])
+
+
+class ScanBlocks(unittest.TestCase):
+  def assertScanEqual(self, grid):
+    expected = list(legacy_scan_blocks(grid))
+    scanned = [(b.top_left, b.bottom_right, b.type_) for b in grid.scan_blocks()]
+    self.assertEqual(expected, scanned)
+
+  def test_workbooks(self):
+    self.assertTrue(workbooks)
+    rnd = random.Random(0)
+
+    for filename in workbooks:
+      workbook_model = WorkbookModel()
+      workbook_model.load_file(filename)
+
+      for sheet_name in workbook_model.sheet_names():
+        grid = workbook_model.sheet_grids[sheet_name]
+        self.assertScanEqual(grid)
+
+        for k in rnd.sample(range(len(grid.set_categories)), len(grid.set_categories)//10):
+          grid.set_categories[k] = rnd.choice(CellCategory.categories())
+        self.assertScanEqual(grid)
+
+  def test_incremental_update(self):
+    rnd = random.Random(0)
+
+    for filename in workbooks:
+      workbook_model = WorkbookModel()
+      workbook_model.load_file(filename)
+
+      for sheet_name in workbook_model.sheet_names():
+        grid = workbook_model.sheet_grids[sheet_name]
+        for _ in range(20):
+          first = rnd.randrange(grid.row_count)
+          last = min(first + rnd.randint(0, 3), grid.row_count-1)
+          left = rnd.randrange(grid.column_count)
+          category = rnd.choice(CellCategory.categories() + [-1])
+          for i in range(first, last+1):
+            for j in range(left, min(left+5, grid.column_count)):
+              grid.set_category(i, j, category)
+
+          grid.update((first, last))
+          self.assertEqual(
+            [(b.top_left, b.bottom_right, b.type_) for b in grid.blocks.indices()],
+            [(b.top_left, b.bottom_right, b.type_) for b in grid.scan_blocks()]
+          )
+
+        graph = grid.blocks.graph()
+        self.assertEqual(set(grid.blocks.indices()), set(graph))
+        for block in grid.blocks.data_blocks():
+          self.assertIs(graph[block].label, grid.blocks.next_block(
+            block, Direction.Left, (-1, -1), (block.row_count(), 1), CellCategory.Label
+          ))
+          self.assertIs(graph[block].top, grid.blocks.next_block(block, Direction.Top))
+
+  def test_insert_row(self):
+    workbook_model = WorkbookModel()
+    workbook_model.load_file(os.path.join(os.path.dirname(workbooks[0]), 'roof.xlsx'), jobs=1)
+    grid = workbook_model.sheet_grids[workbook_model.sheet_names()[0]]
+    blocks = [(b.top_left, b.bottom_right, b.type_) for b in grid.blocks.indices()]
+    row = min(top_left[0] for top_left, _, _ in blocks)
+
+    grid.insert_row(row)
+    self.assertEqual(
+      [((t+1, l), (b+1, r), type_) for (t, l), (b, r), type_ in blocks],
+      [(b.top_left, b.bottom_right, b.type_) for b in grid.blocks.indices()]
+    )
+    grid.update((row, row))
+    self.assertEqual(
+      [((t+1, l), (b+1, r), type_) for (t, l), (b, r), type_ in blocks],
+      [(b.top_left, b.bottom_right, b.type_) for b in grid.blocks.indices()]
+    )
+
+    grid.remove_row(row)
+    self.assertEqual(blocks, [(b.top_left, b.bottom_right, b.type_) for b in grid.blocks.indices()])
+
+
+class LoadFile(unittest.TestCase):
+  def test_jobs(self):
+    for filename in workbooks:
+      serial, parallel = WorkbookModel(), WorkbookModel()
+      serial.load_file(filename, jobs=1)
+      progress = []
+      parallel.load_file(filename, lambda *args: progress.append(args), jobs=2)
+
+      n = len(serial.sheet_names())
+      self.assertEqual([(i+1, n) for i in range(n)], progress)
+      for sheet_name in serial.sheet_names():
+        a, b = serial.sheet_grids[sheet_name], parallel.sheet_grids[sheet_name]
+        self.assertEqual((a.values, a.formulas, a.categories), (b.values, b.formulas, b.categories))
+        self.assertEqual([(x.top_left, x.bottom_right, x.type_) for x in a.blocks.blocks],
+                         [(x.top_left, x.bottom_right, x.type_) for x in b.blocks.blocks])
+
+  def test_cached_values(self):
+    for filename in workbooks:
+      full, streamed = ExcelLoader(filename), ExcelLoader(filename, read_only=True)
+      for sheet_name in full.sheet_names():
+        a, b = SheetGrid(sheet_name, full), SheetGrid(sheet_name, streamed)
+        self.assertEqual((a.values, a.formulas), (b.values, b.formulas))
+        for value, formula in zip(a.values, a.formulas):
+          if formula and value is not None:
+            self.assertTrue(formula.startswith('='))
+            self.assertFalse(is_string(value) and value.replace('.', '', 1).isdigit())
+      full.close()
+      streamed.close()
+
+  def test_cache(self):
+    with tempfile.TemporaryDirectory() as directory:
+      cache = WorkbookCache(directory)
+      for filename in workbooks:
+        loaded, cached = WorkbookModel(), WorkbookModel()
+        loaded.load_file(filename, jobs=1, cache=cache)
+        self.assertTrue(cached.load_cached(filename, cache))
+        self.assertEqual(loaded.sheet_names(), cached.sheet_names())
+        for sheet_name in loaded.sheet_names():
+          self.assertEqual(loaded.sheet_grids[sheet_name].state(), cached.sheet_grids[sheet_name].state())
+
+      with open(cache.path(workbooks[0]), 'wb') as f:
+        f.write(b'damaged')
+      self.assertIsNone(cache.get(workbooks[0]))
+      self.assertFalse(os.path.exists(cache.path(workbooks[0])))
+
+      # entries of another version are not read and evicted first
+      path = cache.path(workbooks[1])
+      cache.version += 1
+      self.assertNotEqual(path, cache.path(workbooks[1]))
+      self.assertIsNone(cache.get(workbooks[1]))
+      WorkbookModel().load_file(workbooks[1], jobs=1, cache=cache)
+      os.utime(cache.path(workbooks[1]), (0, 0))
+      cache.max_size = os.path.getsize(cache.path(workbooks[1]))
+      cache.evict()
+      self.assertEqual([os.path.basename(cache.path(workbooks[1]))], os.listdir(directory))
+
+      cache.max_size = 0
+      cache.evict()
+      self.assertEqual([], os.listdir(directory))
+
+  def test_export(self):
+    workbook_model = WorkbookModel()
+    workbook_model.load_file(os.path.join(os.path.dirname(workbooks[0]), 'roof.xlsx'), jobs=1)
+    tables = [table for name in workbook_model.sheet_names()
+      for table in workbook_model.sheet_grids[name].blocks.tables()]
+    self.assertTrue(tables)
+
+    with tempfile.TemporaryDirectory() as directory:
+      for table in tables:
+        path = os.path.join(directory, 'block')
+        write_csv(path + '.csv', table)
+        with open(path + '.csv', newline='') as f:
+          lines = list(csv.reader(f))
+        self.assertEqual(['Index'] + [str(label) for label in table.labels], lines[0])
+        self.assertEqual(len(table.index) + 1, len(lines))
+
+        write_columnar(path + '.xcol', table)
+        _, index, columns = read_columnar(path + '.xcol')
+        self.assertEqual(len(table.index), len(index))
+        self.assertEqual([str(label) for label in table.labels], [name for name, _ in columns])
+        for values, (_, read) in zip(table.rows, columns):
+          self.assertEqual([value if value is None or type(value) in (int, float) else str(value) for value in values], read)
+
+      # blank and repeated labels are common
+      path = os.path.join(directory, 'labels.xcol')
+      write_columnar(path, ExportTable('t', ['a', 'a', None], [1, 2], [[1, None], ['x', 2], [3, 4]], None))
+      self.assertEqual(('t', ['1', '2'], [('a', [1, None]), ('a', ['x', '2']), ('', [3, 4])]), read_columnar(path))
+
+      written = workbook_model.sheet_grids[workbook_model.sheet_names()[0]].blocks.export(directory, jobs=4)
+      self.assertEqual(len(tables), len(set(written)))
+      self.assertTrue(all(os.path.exists(path) for path in written))
+
+  def test_workbook_names(self):
+    self.assertEqual(['x.xls', 'x.xlsx', 'X.xls-3', 'x.xls-2', 'x.xls-2-2'],
+      workbook_names(['a/x.xls', 'a/x.xlsx', 'b/X.xls', 'c/x.xls-2', 'd/x.xls-2']))
+
+    filename = os.path.join(os.path.dirname(workbooks[0]), 'roof.xlsx')
+    with tempfile.TemporaryDirectory() as directory:
+      written = [path for name in workbook_names([filename, filename])
+        for path in process_workbook(filename, directory=directory, name=name)[2]]
+      self.assertTrue(written)
+      self.assertEqual(len(written), len(set(written)))
+      self.assertEqual(['roof.xlsx', 'roof.xlsx-2'], sorted(os.listdir(directory)))
+
+  def test_hdf5_data(self):
+    rows, numeric = hdf5_data(ExportTable(None, ['a', 'b'], [1, 2], [[1, None], [2.5, True]], None))
+    self.assertEqual(([['1', ''], ['2.5', 'True']], False), (rows, numeric))
+    rows, numeric = hdf5_data(ExportTable(None, ['a'], [1, 2], [[1, None]], None))
+    self.assertTrue(numeric)
+    self.assertEqual(1.0, rows[0][0])
+    self.assertNotEqual(rows[0][1], rows[0][1])
+
+    workbook_model = WorkbookModel()
+    workbook_model.load_file(os.path.join(os.path.dirname(workbooks[0]), 'roof.xlsx'), jobs=1)
+    tables = [table for name in workbook_model.sheet_names()
+      for table in workbook_model.sheet_grids[name].blocks.tables()]
+
+    # the calls to h5py without writing any file
+    with mock.patch.object(xls_model, 'h5py') as h5py, mock.patch.object(xls_model, 'numpy') as numpy:
+      written = write_hdf5('roof.h5', workbook_model)
+    h5py.File.assert_called_once_with('roof.h5', 'w')
+    self.assertEqual(len(tables), len(written))
+    self.assertEqual([mock.call(rows, dtype='f8') for rows, numeric in map(hdf5_data, tables) if numeric],
+      numpy.array.call_args_list)
+
+  @unittest.skipIf(xls_model.h5py is None, 'h5py is not installed')
+  def test_hdf5(self):
+    workbook_model = WorkbookModel()
+    workbook_model.load_file(os.path.join(os.path.dirname(workbooks[0]), 'roof.xlsx'), jobs=1)
+
+    with tempfile.TemporaryDirectory() as directory:
+      path = os.path.join(directory, 'roof.h5')
+      written = write_hdf5(path, workbook_model)
+      self.assertTrue(written)
+      with xls_model.h5py.File(path, 'r') as f:
+        for name in written:
+          data = f[name]
+          self.assertEqual((len(data.dims[0][0]), len(data.dims[1][0])), data.shape)
+
 
 if __name__ == '__main__':
   unittest.main()